@@ -1,24 +1,41 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
+import contextlib
 import gzip
 import io
 import json
 import os
 import shutil
+import re
 import sys
 import tempfile
+import threading
+import time
+import uuid
 import singer
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from jsonschema import Draft7Validator, FormatChecker
 
+from target_s3_csv import coercion
+from target_s3_csv import dedup
+from target_s3_csv import dialects
+from target_s3_csv import flush
+from target_s3_csv import journal
+from target_s3_csv import profiling
+from target_s3_csv import projection
 from target_s3_csv import s3
 from target_s3_csv import utils
+from target_s3_csv.writer import StreamWriter
 
 logger = singer.get_logger('target_s3_csv')
 
+jsonschema = utils.lazy_import('jsonschema')
+
+# Directory in temp_dir of the temp directories of the sources in fan-in mode
+SOURCES_TEMP_DIR = 'target-s3-csv-sources'
+
 
 def emit_state(state):
     if state is not None:
@@ -28,17 +45,35 @@ def emit_state(state):
         sys.stdout.flush()
 
 
+def upload_files(files, config, s3_client, manifest_key=None, manifest_files=None):
+    """Uploads local files to S3 with the compression and encryption settings of the config"""
+    return s3.upload_files(files, s3_client, config['s3_bucket'],
+                           config.get("compression"), config.get('encryption_type'), config.get('encryption_key'),
+                           skip_unchanged=config.get('skip_unchanged_files', False),
+                           manifest_key=manifest_key,
+                           manifest_files=manifest_files)
+
+
 # pylint: disable=too-many-locals,too-many-branches,too-many-statements
-def persist_messages(messages, config, s3_client):
+def persist_messages(messages, config, s3_client, source=None):
     state = None
     schemas = {}
     key_properties = {}
-    headers = {}
     validators = {}
+    encoders = {}
+    coercers = {}
+    projectors = {}
+    record_filters = {}
 
     delimiter = config.get('delimiter', ',')
     quotechar = config.get('quotechar', '"')
 
+    # Named CSV dialect with column encoders compiled from the stream schemas
+    dialect = None
+    if config.get('csv_dialect'):
+        dialect = dialects.get_dialect(config['csv_dialect'], config.get('delimiter'), config.get('quotechar'),
+                                       config.get('escapechar'))
+
     # Use the system specific temp directory if no custom temp_dir provided
     temp_dir = os.path.expanduser(config.get('temp_dir', tempfile.gettempdir()))
 
@@ -46,12 +81,42 @@ def persist_messages(messages, config, s3_client):
     if temp_dir:
         os.makedirs(temp_dir, exist_ok=True)
 
-    # dictionary to hold csv filename per stream
-    filenames = {}
+    # Finish the uploads of previous runs that crashed after writing their files
+    run_journal = journal.Journal(temp_dir, journal.get_upload_fingerprint(config))
+    recovered_files = journal.recover(temp_dir, run_journal)
+    if recovered_files:
+        upload_files(recovered_files, config, s3_client)
+
+    # dictionary to hold csv writer per stream
+    writers = {}
+
+    # Files of streams with a flush policy are closed and uploaded during the run
+    flush_scheduler = flush.FlushScheduler(config)
+    parts = {}
+    flushed_files = []
+
+    def flush_stream(stream_name, reason):
+        file = writers.pop(stream_name).close()
+        run_journal.file_completed(stream_name, file)
+        logger.info("Flushing %s records of stream %s, reason: %s", file['record_count'], stream_name, reason)
+
+        started_at = time.monotonic()
+        uploaded = upload_files([file], config, s3_client)
+        flush_scheduler.file_flushed(stream_name, reason, uploaded[0], time.monotonic() - started_at)
+
+        flushed_files.extend(uploaded)
+        parts[stream_name] = parts.get(stream_name, 0) + 1
 
     now = datetime.now().strftime('%Y%m%dT%H%M%S')
+    # Concurrent runs sharing temp_dir can start in the same second, their local files must not collide
+    run_id = '{}-{}'.format(os.getpid(), uuid.uuid4().hex)
 
     for message in messages:
+        # Deadlines are checked on every message, so quiet streams are flushed while others are busy
+        for stream_name in flush_scheduler.get_expired_streams():
+            if stream_name in writers:
+                flush_stream(stream_name, 'latency')
+
         try:
             o = singer.parse_message(message).asdict()
         except json.decoder.JSONDecodeError:
@@ -65,6 +130,12 @@ def persist_messages(messages, config, s3_client):
                 raise Exception("A record for stream {}"
                                 "was encountered before a corresponding schema".format(stream_name))
 
+            # Filtered records and not selected columns are dropped before anything else is done with them
+            if stream_name in record_filters and not record_filters[stream_name](o['record']):
+                continue
+            if stream_name in projectors:
+                o['record'] = projectors[stream_name](o['record'])
+
             # Validate record
             try:
                 validators[stream_name].validate(utils.float_to_decimal(o['record']))
@@ -81,44 +152,41 @@ def persist_messages(messages, config, s3_client):
             else:
                 record_to_load = utils.remove_metadata_values_from_record(o)
 
-            if stream_name not in filenames:
-                filename = os.path.expanduser(os.path.join(temp_dir, stream_name + '-' + now + '.csv'))
-
-                filenames[stream_name] = {
-                    'filename': filename,
-                    'target_key': utils.get_target_key(message=o,
-                                                       prefix=config.get('s3_key_prefix', ''),
-                                                       timestamp=now,
-                                                       naming_convention=config.get('naming_convention'))
-
-                }
-            else:
-                filename = filenames[stream_name]['filename']
-
-            file_is_empty = (not os.path.isfile(filename)) or os.stat(filename).st_size == 0
+            if stream_name not in writers:
+                part = parts.get(stream_name, 0)
+                filename = os.path.expanduser(os.path.join(temp_dir, '{}-{}-{}.csv'.format(stream_name, now, run_id)))
+                if part:
+                    filename = utils.add_part_suffix(filename, part)
+                target_key = utils.get_target_key(message=o,
+                                                  prefix=config.get('s3_key_prefix', ''),
+                                                  timestamp=now,
+                                                  naming_convention=config.get('naming_convention'),
+                                                  source=source,
+                                                  part=part)
+
+                run_journal.file_opened(stream_name, filename, target_key)
+                writers[stream_name] = StreamWriter(
+                    filename, target_key,
+                    delimiter=delimiter,
+                    quotechar=quotechar,
+                    dialect=dialect,
+                    encoders=encoders.get(stream_name),
+                    key_properties=key_properties.get(stream_name) if config.get('deduplicate_records') else None,
+                    max_keys_in_memory=config.get('deduplicate_max_keys_in_memory', dedup.DEFAULT_MAX_KEYS_IN_MEMORY),
+                    sort_columns=utils.get_sort_columns(config, stream_name, key_properties.get(stream_name)),
+                    sort_max_bytes_in_memory=int(config.get('sort_max_memory_mb', 256) * 1024 * 1024),
+                    schema=schemas[stream_name])
+                flush_scheduler.file_opened(stream_name)
+
+            if stream_name in coercers:
+                record_to_load = coercers[stream_name](record_to_load)
 
             flattened_record = utils.flatten_record(record_to_load)
+            writers[stream_name].write(flattened_record)
 
-            if stream_name not in headers and not file_is_empty:
-                with open(filename, 'r') as csvfile:
-                    reader = csv.reader(csvfile,
-                                        delimiter=delimiter,
-                                        quotechar=quotechar)
-                    first_line = next(reader)
-                    headers[stream_name] = first_line if first_line else flattened_record.keys()
-            else:
-                headers[stream_name] = flattened_record.keys()
-
-            with open(filename, 'a') as csvfile:
-                writer = csv.DictWriter(csvfile,
-                                        headers[stream_name],
-                                        extrasaction='ignore',
-                                        delimiter=delimiter,
-                                        quotechar=quotechar)
-                if file_is_empty:
-                    writer.writeheader()
-
-                writer.writerow(flattened_record)
+            flush_reason = flush_scheduler.get_flush_reason(stream_name, writers[stream_name].bytes_written)
+            if flush_reason:
+                flush_stream(stream_name, flush_reason)
 
         elif message_type == 'STATE':
             logger.debug('Setting state to {}'.format(o['value']))
@@ -126,29 +194,150 @@ def persist_messages(messages, config, s3_client):
 
         elif message_type == 'SCHEMA':
             stream_name = o['stream']
+
+            select_columns = (config.get('select_columns') or {}).get(stream_name)
+            if select_columns:
+                # Dropped key or sort columns would be null in every record and silently collapse or not sort the rows
+                required_columns = list(o['key_properties'] or []) if config.get('deduplicate_records') else []
+                required_columns += utils.get_sort_columns(config, stream_name, o['key_properties']) or []
+                missing_columns = projection.get_missing_columns(required_columns, select_columns)
+                if missing_columns:
+                    raise Exception("Columns {} of stream {} are needed for deduplication or sorting "
+                                    "but they are not in select_columns".format(', '.join(missing_columns),
+                                                                                stream_name))
+                o['schema'] = projection.project_schema(o['schema'], select_columns)
+                projectors[stream_name] = projection.make_projector(select_columns)
+
+            record_filter = (config.get('record_filters') or {}).get(stream_name)
+            if record_filter:
+                record_filters[stream_name] = projection.compile_filter(record_filter)
+
             schemas[stream_name] = o['schema']
 
             if config.get('add_metadata_columns'):
                 schemas[stream_name] = utils.add_metadata_columns_to_schema(o)
 
             schema = utils.float_to_decimal(o['schema'])
-            validators[stream_name] = Draft7Validator(schema, format_checker=FormatChecker())
+            validators[stream_name] = jsonschema.Draft7Validator(schema, format_checker=jsonschema.FormatChecker())
             key_properties[stream_name] = o['key_properties']
+
+            if dialect:
+                encoders[stream_name] = dialects.build_column_encoders(o['schema'], dialect)
+
+            if config.get('coerce_types'):
+                coercers[stream_name] = coercion.build_record_coercer(o['schema'])
         elif message_type == 'ACTIVATE_VERSION':
             logger.debug('ACTIVATE_VERSION message')
         else:
             logger.warning("Unknown message type {} in message {}".format(o['type'], o))
 
-    # Upload created CSV files to S3
-    s3.upload_files(iter(filenames.values()), s3_client, config['s3_bucket'], config.get("compression"),
-                    config.get('encryption_type'), config.get('encryption_key'))
+    manifest_key = None
+    if config.get('write_manifest'):
+        manifest_key = '{}manifest-{}{}.json'.format(config.get('s3_key_prefix') or '',
+                                                     f'{source}-' if source else '',
+                                                     now)
+
+    files = []
+    for stream_name, writer in writers.items():
+        file = writer.close()
+        run_journal.file_completed(stream_name, file)
+        files.append(file)
+
+    # Upload created CSV files to S3. Runs without records don't touch S3 at all
+    if files or flushed_files:
+        uploaded = upload_files(files, config, s3_client, manifest_key=manifest_key, manifest_files=flushed_files)
+        for stream_name, file in zip(writers, uploaded):
+            flush_scheduler.file_flushed(stream_name, 'end', file)
+    run_journal.close()
 
     return state
 
 
+def get_source_ids(inputs):
+    """Returns unique, file name safe identifiers of the input sources"""
+    source_ids = []
+    for path in inputs:
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', os.path.basename(path.rstrip(os.sep))) or 'input'
+        source_id, suffix = name, len(source_ids)
+        # A suffixed id can be taken too, by an input whose name already ends with the suffix
+        while source_id in source_ids:
+            source_id = '{}-{}'.format(name, suffix)
+            suffix += 1
+        source_ids.append(source_id)
+    return source_ids
+
+
+def persist_sources(inputs, config, s3_client, max_workers=None, profile=None):
+    """
+    Fan-in mode: consumes several input files or named pipes concurrently,
+    each one with its own writers, temp directory and state, while sharing
+    the S3 client and its connection pool.
+
+    The state of every source is emitted as soon as the source is finished,
+    as {"source": <input>, "value": <state>}.
+
+    If a profile is given then the work of every source is profiled in its worker thread.
+
+    Returns the number of sources that failed.
+    """
+    temp_dir = os.path.expanduser(config.get('temp_dir', tempfile.gettempdir()))
+    emit_lock = threading.Lock()
+
+    def persist_source(path, source_id):
+        # Every source has its own temp directory, so files and journals of sources don't collide.
+        # They are in a dedicated directory, inputs might be in temp_dir too
+        source_config = {**config, 'temp_dir': os.path.join(temp_dir, SOURCES_TEMP_DIR, source_id)}
+        with profile.profile_thread() if profile else contextlib.nullcontext():
+            with open(path, 'r', encoding='utf-8') as input_messages:
+                messages = profile.wrap_messages(input_messages) if profile else input_messages
+                state = persist_messages(messages, source_config, s3_client, source=source_id)
+
+        if state is not None:
+            with emit_lock:
+                emit_state({'source': path, 'value': state})
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max_workers or len(inputs)) as executor:
+        futures = {executor.submit(persist_source, path, source_id): path
+                   for path, source_id in zip(inputs, get_source_ids(inputs))}
+        for future, path in futures.items():
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Failed to persist messages of source {}".format(path))
+                failed += 1
+
+    return failed
+
+
+def get_profile(config, profile_mode=None):
+    """Returns the profile of the run if it's requested by the --profile argument or the profile option"""
+    profile_mode = profile_mode or config.get('profile')
+    if not profile_mode:
+        return None
+    if profile_mode is True:
+        profile_mode = 'cprofile'
+
+    profile_dir = os.path.expanduser(config.get('profile_dir') or config.get('temp_dir') or tempfile.gettempdir())
+    return profiling.Profile(profile_mode, profile_dir, record_sample_rate=config.get('profile_record_sample_rate'))
+
+
+def upload_profile(profile, config, s3_client):
+    """Uploads the profile of the run next to the data files"""
+    s3.upload_file(profile.path, s3_client, config['s3_bucket'],
+                   '{}profiles/{}'.format(config.get('s3_key_prefix') or '', os.path.basename(profile.path)),
+                   encryption_type=config.get('encryption_type'),
+                   encryption_key=config.get('encryption_key'))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='Config file')
+    parser.add_argument('-i', '--input', dest='inputs', action='append',
+                        help='Input file or named pipe to read messages from instead of STDIN. '
+                             'Can be repeated to consume multiple taps concurrently')
+    parser.add_argument('--profile', nargs='?', const='cprofile', choices=profiling.PROFILE_MODES,
+                        help='Profile the run with cProfile (default) or with the sampling profiler')
     args = parser.parse_args()
 
     if args.config:
@@ -162,10 +351,28 @@ def main():
         logger.error("Invalid configuration:\n   * {}".format('\n   * '.join(config_errors)))
         sys.exit(1)
 
-    s3_client = s3.create_client(config)
+    # Every input of the fan-in mode uploads from its own thread, they need a connection each
+    max_pool_connections = max(len(args.inputs), s3.DEFAULT_MAX_POOL_CONNECTIONS) if args.inputs else None
+    s3_client = s3.LazyClient(config, max_pool_connections)
+    profile = get_profile(config, args.profile)
+    failed = 0
+    state = None
+
+    with profile or contextlib.nullcontext():
+        if args.inputs:
+            failed = persist_sources(args.inputs, config, s3_client, profile=profile)
+        else:
+            input_messages = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+            if profile:
+                input_messages = profile.wrap_messages(input_messages)
+            state = persist_messages(input_messages, config, s3_client)
 
-    input_messages = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    state = persist_messages(input_messages, config, s3_client)
+    if profile and config.get('profile_upload'):
+        upload_profile(profile, config, s3_client)
+
+    if failed:
+        logger.error("{} of {} sources failed".format(failed, len(args.inputs)))
+        sys.exit(1)
 
     emit_state(state)
     logger.debug("Exiting normally")
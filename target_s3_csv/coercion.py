@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import datetime
+import json
+
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from typing import Callable, Dict, List, Optional
+
+import ciso8601
+import singer
+
+TRUE_STRINGS = {'true', 't', 'yes', 'y', '1'}
+FALSE_STRINGS = {'false', 'f', 'no', 'n', '0'}
+
+
+def coerce_datetime(value):
+    """Normalizes date-time strings to UTC in the singer date-time format, i.e. 2020-01-31T10:20:30.000000Z"""
+    if not isinstance(value, str):
+        return value
+
+    try:
+        dtime = ciso8601.parse_datetime(value)  # pylint: disable=c-extension-no-member
+    except ValueError:
+        try:
+            dtime = singer.utils.strptime_to_utc(value)
+        except (ValueError, OverflowError):
+            return value
+
+    if dtime.tzinfo is not None:
+        dtime = dtime.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return dtime.isoformat(timespec='microseconds') + 'Z'
+
+
+def coerce_date(value):
+    """Normalizes date strings to YYYY-MM-DD"""
+    if not isinstance(value, str):
+        return value
+
+    try:
+        return ciso8601.parse_datetime(value).date().isoformat()  # pylint: disable=c-extension-no-member
+    except ValueError:
+        return value
+
+
+def coerce_boolean(value):
+    """Turns the common textual and numeric representations of booleans into bool"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in TRUE_STRINGS:
+            return True
+        if lowered in FALSE_STRINGS:
+            return False
+    elif value in (0, 1):
+        return bool(value)
+    return value
+
+
+def coerce_integer(value):
+    """Turns integral numbers and numeric strings into int"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    try:
+        number = Decimal(value if isinstance(value, str) else str(value))
+    except (InvalidOperation, ValueError, TypeError):
+        return value
+    if not number.is_finite():
+        return value
+    if number == number.to_integral_value():
+        return int(number)
+    return value
+
+
+def make_coerce_number(scale: Optional[int]) -> Callable:
+    """
+    Returns a function that writes numbers in fixed point notation, never with exponent,
+    rounded half up to the given number of decimal places if any, as warehouses round NUMERIC values
+    """
+    exponent = Decimal(1).scaleb(-scale) if scale is not None else None
+
+    def coerce_number(value):
+        if isinstance(value, bool):
+            return value
+        try:
+            number = Decimal(value if isinstance(value, str) else str(value))
+            if not number.is_finite():
+                return value
+            if exponent is not None:
+                number = number.quantize(exponent, rounding=ROUND_HALF_UP)
+        except (InvalidOperation, ValueError, TypeError):
+            return value
+        return format(number, 'f')
+
+    return coerce_number
+
+
+def coerce_json(value):
+    """Serialises objects and arrays of JSON columns"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'), default=str)
+    return value
+
+
+def get_scale(multiple_of) -> Optional[int]:
+    """Number of decimal places allowed by a multipleOf keyword"""
+    if multiple_of is None:
+        return None
+    exponent = Decimal(str(multiple_of)).normalize().as_tuple().exponent
+    return max(-exponent, 0)
+
+
+def _get_types(prop: Dict) -> List[str]:
+    types = prop.get('type', [])
+    if isinstance(types, str):
+        types = [types]
+    return [t for t in types if t != 'null']
+
+
+# pylint: disable=too-many-return-statements
+def _compile_property(prop: Dict) -> Optional[Callable]:
+    """Returns the coercion of a single schema property, or None if its values are passed through"""
+    types = _get_types(prop)
+    fmt = prop.get('format')
+
+    if 'string' in types and fmt == 'date-time':
+        return coerce_datetime
+    if 'string' in types and fmt == 'date':
+        return coerce_date
+    if types == ['boolean']:
+        return coerce_boolean
+    if types == ['integer']:
+        return coerce_integer
+    if types and set(types) <= {'integer', 'number'}:
+        return make_coerce_number(get_scale(prop.get('multipleOf')))
+    if 'object' in types:
+        if prop.get('properties'):
+            return _compile_object(prop)
+        # Objects without properties are JSON columns
+        return coerce_json
+    if types == ['array']:
+        return coerce_json
+    return None
+
+
+def _compile_object(schema: Dict) -> Optional[Callable]:
+    coercions = []
+    for key, prop in (schema.get('properties') or {}).items():
+        coerce = _compile_property(prop)
+        if coerce is not None:
+            coercions.append((key, coerce))
+
+    if not coercions:
+        return None
+
+    def coerce_object(record):
+        if not isinstance(record, dict):
+            return record
+        for key, coerce in coercions:
+            value = record.get(key)
+            if value is not None:
+                record[key] = coerce(value)
+        return record
+
+    return coerce_object
+
+
+def build_record_coercer(schema: Dict) -> Callable[[Dict], Dict]:
+    """
+    Compiles the type coercion of the records of a stream from its JSON schema.
+
+    Only the properties that need coercion are visited for every record,
+    string and untyped properties are passed through as they are.
+    Records are coerced in place, before flattening.
+    """
+    coerce_object = _compile_object(schema)
+    if coerce_object is None:
+        return lambda record: record
+    return coerce_object
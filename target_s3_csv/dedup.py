@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import sqlite3
+
+from typing import Dict, Iterator, List, Tuple
+
+# Number of keys kept in memory before spilling the index to disk
+DEFAULT_MAX_KEYS_IN_MEMORY = 1000000
+
+
+def get_key(record: Dict, key_properties: List[str]) -> bytes:
+    """Returns a compact, fixed size digest of the primary key of a record"""
+    key = json.dumps([record.get(k) for k in key_properties], default=str, separators=(',', ':'))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+
+class KeyIndex:
+    """
+    Last-write-wins index of the position of the latest row of every primary key.
+
+    Keys are 16 byte digests mapped to the offset and length of the row in the
+    spool file. The index is kept in a dict until it reaches max_keys_in_memory
+    keys, then it's spilled into an SQLite table on disk and the dict starts
+    over. Spills only ever replace older positions with newer ones, so the
+    latest row of every key wins.
+    """
+
+    def __init__(self, path, max_keys_in_memory=DEFAULT_MAX_KEYS_IN_MEMORY):
+        self.path = path
+        self.max_keys_in_memory = max_keys_in_memory
+        self._keys = {}
+        self._db = None
+
+    def add(self, key: bytes, offset: int, length: int):
+        """Sets the position of the latest row of a key"""
+        self._keys[key] = (offset, length)
+        if len(self._keys) >= self.max_keys_in_memory:
+            self._spill()
+
+    def _spill(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            # The index is rebuilt from scratch if anything goes wrong, no need for durability
+            self._db.execute('PRAGMA journal_mode = OFF')
+            self._db.execute('PRAGMA synchronous = OFF')
+            self._db.execute('CREATE TABLE keys (key BLOB PRIMARY KEY, offset INTEGER, length INTEGER) WITHOUT ROWID')
+
+        self._db.executemany('INSERT OR REPLACE INTO keys VALUES (?, ?, ?)',
+                             ((key, offset, length) for key, (offset, length) in self._keys.items()))
+        self._db.commit()
+        self._keys.clear()
+
+    def positions(self) -> Iterator[Tuple[int, int]]:
+        """Returns the offset and length of the surviving rows, in the order they were written"""
+        if self._db is None:
+            return iter(sorted(self._keys.values()))
+
+        self._spill()
+        return self._db.execute('SELECT offset, length FROM keys ORDER BY offset')
+
+    def close(self):
+        """Releases the index and removes it from disk"""
+        self._keys.clear()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import json
+import re
+
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional
+
+from target_s3_csv import utils
+
+# Named CSV dialects that can be loaded by the warehouse COPY commands with
+# their default settings.
+#   null:       text written for None values. Strings that equal to it are always quoted
+#   quoting:    'minimal' quotes values containing special characters, 'all' quotes every non-null value
+#   escapechar: if set, escapes quotechar and itself inside quoted values instead of doubling the quotechar
+DIALECTS = {
+    'rfc4180': {
+        'delimiter': ',',
+        'quotechar': '"',
+        'escapechar': None,
+        'lineterminator': '\r\n',
+        'quoting': 'minimal',
+        'null': '',
+        'true': 'true',
+        'false': 'false',
+    },
+    # COPY ... CSV, null values match the default NULL AS '\N'
+    'redshift': {
+        'delimiter': ',',
+        'quotechar': '"',
+        'escapechar': None,
+        'lineterminator': '\n',
+        'quoting': 'minimal',
+        'null': '\\N',
+        'true': 'true',
+        'false': 'false',
+    },
+    # FIELD_OPTIONALLY_ENCLOSED_BY = '"', unquoted empty fields are NULL, "" is an empty string
+    'snowflake': {
+        'delimiter': ',',
+        'quotechar': '"',
+        'escapechar': None,
+        'lineterminator': '\n',
+        'quoting': 'all',
+        'null': '',
+        'true': 'true',
+        'false': 'false',
+    },
+    # Default null_marker of BigQuery load jobs is the empty string
+    'bigquery': {
+        'delimiter': ',',
+        'quotechar': '"',
+        'escapechar': None,
+        'lineterminator': '\n',
+        'quoting': 'minimal',
+        'null': '',
+        'true': 'true',
+        'false': 'false',
+    },
+}
+
+
+def validate_options(config: Dict) -> List[str]:
+    """Returns the errors of the csv_dialect and escapechar options of the config"""
+    errors = []
+    if config.get('csv_dialect') and config['csv_dialect'] not in DIALECTS:
+        errors.append("Unknown csv_dialect: [{}]. Expected one of: {}".format(config['csv_dialect'],
+                                                                            ', '.join(DIALECTS)))
+
+    escapechar = config.get('escapechar')
+    if escapechar is not None:
+        if not isinstance(escapechar, str) or len(escapechar) != 1:
+            errors.append("Invalid escapechar: [{}]. Expected a one-character string".format(escapechar))
+        elif escapechar in (config.get('delimiter') or ',', config.get('quotechar') or '"', '\r', '\n'):
+            errors.append("Invalid escapechar: [{}]. It can't be the delimiter, the quotechar "
+                          "or a line terminator".format(escapechar))
+    return errors
+
+
+def get_dialect(name: str, delimiter: Optional[str] = None, quotechar: Optional[str] = None,
+                escapechar: Optional[str] = None) -> Dict:
+    """
+    Returns the settings of a named dialect.
+    Explicitly configured delimiter, quotechar and escapechar override the ones of the preset.
+    """
+    try:
+        dialect = dict(DIALECTS[name])
+    except KeyError:
+        raise NotImplementedError(
+            "CSV dialect '{}' is not supported. Expected one of: {}".format(name, ', '.join(DIALECTS))
+        ) from None
+
+    if delimiter:
+        dialect['delimiter'] = delimiter
+    if quotechar:
+        dialect['quotechar'] = quotechar
+    if escapechar:
+        dialect['escapechar'] = escapechar
+
+    return dialect
+
+
+def flatten_schema(schema: Dict, parent_key: Optional[List] = None, sep: str = '__') -> Dict[str, List[str]]:
+    """
+    Returns the JSON schema types of every column that flatten_record
+    produces from records of the given schema
+    """
+    if parent_key is None:
+        parent_key = []
+
+    columns = {}
+    for k, prop in (schema.get('properties') or {}).items():
+        types = prop.get('type', [])
+        if isinstance(types, str):
+            types = [types]
+
+        if 'object' in types and prop.get('properties'):
+            columns.update(flatten_schema(prop, parent_key + [k], sep=sep))
+        else:
+            columns[utils.flatten_key(k, parent_key, sep)] = [t for t in types if t != 'null']
+
+    return columns
+
+
+def _make_quote(dialect: Dict) -> Callable[[str], str]:
+    """Returns a function that quotes and escapes a string value according to the dialect"""
+    quotechar = dialect['quotechar']
+    escapechar = dialect['escapechar']
+    null = dialect['null']
+
+    if escapechar:
+        escape_pattern = re.compile('[{}]'.format(re.escape(quotechar + escapechar)))
+
+        def escape(text):
+            return escape_pattern.sub(lambda m: escapechar + m.group(0), text)
+    else:
+        doubled_quotechar = quotechar * 2
+
+        def escape(text):
+            return text.replace(quotechar, doubled_quotechar)
+
+    if dialect['quoting'] == 'all':
+        def quote(text):
+            return quotechar + escape(text) + quotechar
+    else:
+        needs_quoting = re.compile('[{}]'.format(re.escape(
+            dialect['delimiter'] + quotechar + (escapechar or '') + '\r\n'))).search
+
+        def quote(text):
+            if needs_quoting(text) or text == null:
+                return quotechar + escape(text) + quotechar
+            return text
+
+    return quote
+
+
+# pylint: disable=too-many-return-statements,too-many-locals
+def build_column_encoders(schema: Dict, dialect: Dict) -> Dict[str, Callable]:
+    """
+    Compiles a value encoder for every column of the flattened schema.
+
+    Every encoder turns a single value into its final CSV text, with quoting
+    and escaping. Knowing the column type in advance skips the special
+    character checks for numbers and booleans. Values that don't match the
+    schema type fall back to the generic encoder.
+    """
+    quote = _make_quote(dialect)
+    null, true, false = dialect['null'], dialect['true'], dialect['false']
+    all_quoted = dialect['quoting'] == 'all'
+
+    def encode_any(value):
+        if value is None:
+            return null
+        if value is True:
+            return quote(true) if all_quoted else true
+        if value is False:
+            return quote(false) if all_quoted else false
+        if isinstance(value, (list, dict)):
+            return quote(json.dumps(value, separators=(',', ':')))
+        return quote(str(value))
+
+    def encode_boolean(value):
+        if value is True:
+            return encoded_true
+        if value is False:
+            return encoded_false
+        return encode_any(value)
+
+    def encode_number(value):
+        if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+            return quote(str(value)) if all_quoted else str(value)
+        return encode_any(value)
+
+    def encode_string(value):
+        if isinstance(value, str):
+            return quote(value)
+        return encode_any(value)
+
+    encoded_true = quote(true) if all_quoted else true
+    encoded_false = quote(false) if all_quoted else false
+
+    encoders = {}
+    for column, types in flatten_schema(schema).items():
+        if types == ['boolean']:
+            encoders[column] = encode_boolean
+        elif types and set(types) <= {'integer', 'number'}:
+            encoders[column] = encode_number
+        elif types in (['string'], ['array'], ['object']):
+            encoders[column] = encode_string
+        else:
+            encoders[column] = encode_any
+
+    # Columns not in the schema
+    encoders[None] = encode_any
+
+    return encoders
+
+
+def build_row_encoder(headers: List[str], encoders: Dict[str, Callable], dialect: Dict) -> Callable[[Dict], str]:
+    """Returns a function that encodes a flattened record into a CSV line with the given column order"""
+    delimiter = dialect['delimiter']
+    lineterminator = dialect['lineterminator']
+    column_encoders = [(column, encoders.get(column, encoders[None])) for column in headers]
+
+    def encode_row(record):
+        return delimiter.join([encode(record.get(column)) for column, encode in column_encoders]) + lineterminator
+
+    return encode_row
+
+
+def encode_header(headers: List[str], dialect: Dict) -> str:
+    """Encodes the header line of a CSV file"""
+    quote = _make_quote(dialect)
+    return dialect['delimiter'].join([quote(column) for column in headers]) + dialect['lineterminator']
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import time
+import singer
+
+from singer import metrics
+from typing import Dict, List, Optional
+
+LOGGER = singer.get_logger('target_s3_csv')
+
+# Options of the flush policy that can be overridden per stream in flush_streams
+STREAM_OPTIONS = ('target_file_size_mb', 'max_latency_seconds')
+
+# Compressed size of gzipped CSV files relative to their size, until the first file of a stream is compressed
+DEFAULT_GZIP_RATIO = 0.25
+
+# Weight of the latest file in the moving averages of the compression ratio, upload time and ingest rate
+SMOOTHING = 0.5
+
+# Share of max_latency_seconds that's always left for buffering, even if uploads are slower than that
+MIN_BUFFERING_SHARE = 0.1
+
+
+def get_stream_options(config: Dict, stream_name: str) -> Dict:
+    """Returns the flush options of a stream: the global options overridden by the ones of the stream"""
+    options = {
+        'target_file_size_mb': config.get('flush_target_file_size_mb'),
+        'max_latency_seconds': config.get('flush_max_latency_seconds'),
+    }
+    options.update((config.get('flush_streams') or {}).get(stream_name) or {})
+    return options
+
+
+def validate_options(config: Dict) -> List[str]:
+    """Returns the errors of the flush options of the config"""
+    errors = []
+    checked = [('flush_target_file_size_mb', config.get('flush_target_file_size_mb')),
+               ('flush_max_latency_seconds', config.get('flush_max_latency_seconds'))]
+
+    for stream_name, options in (config.get('flush_streams') or {}).items():
+        for key, value in (options or {}).items():
+            if key not in STREAM_OPTIONS:
+                errors.append("Unknown option of stream [{}] in flush_streams: [{}]. Expected one of: {}".format(
+                    stream_name, key, ', '.join(STREAM_OPTIONS)))
+            else:
+                checked.append(('flush_streams.{}.{}'.format(stream_name, key), value))
+
+    for key, value in checked:
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+            errors.append("Invalid value of [{}]: {}. Expected a positive number".format(key, value))
+
+    return errors
+
+
+def _average(average, value):
+    return value if average is None else average + SMOOTHING * (value - average)
+
+
+class StreamFlushPolicy:
+    """
+    Decides when the file of a stream is closed and uploaded during the run.
+
+    A file is flushed when its estimated compressed size reaches the target
+    size, or when its oldest record would otherwise stay in temp_dir for longer
+    than max_latency_seconds, including the time it takes to upload it.
+
+    Compression ratio and upload time are learnt from the flushed files of the
+    stream, so the size estimates and the deadlines adapt to the content of
+    the stream and to the throughput of S3. The ingest rate is measured too,
+    it tells if the stream is bound by the target size or by the latency.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, stream_name, target_file_size_mb=None, max_latency_seconds=None, compression=None):
+        self.stream_name = stream_name
+        self.target_size_bytes = int(target_file_size_mb * 1024 * 1024) if target_file_size_mb else None
+        self.max_latency_seconds = max_latency_seconds or None
+        self.compression_ratio = DEFAULT_GZIP_RATIO if compression == 'gzip' else 1.0
+        self.upload_seconds = None
+        self.bytes_per_second = None
+        self.records_per_second = None
+        self.opened_at = None
+        self.deadline = None
+        self.flushed_files = 0
+
+    def file_opened(self, now: float):
+        """Starts the clock of a new file of the stream"""
+        self.opened_at = now
+        if self.max_latency_seconds:
+            upload_seconds = min(self.upload_seconds or 0.0,
+                                 self.max_latency_seconds * (1 - MIN_BUFFERING_SHARE))
+            self.deadline = now + self.max_latency_seconds - upload_seconds
+
+    def get_flush_reason(self, bytes_written: int, now: float) -> Optional[str]:
+        """Returns why the current file should be flushed, or None if it can grow further"""
+        if self.target_size_bytes and bytes_written * self.compression_ratio >= self.target_size_bytes:
+            return 'size'
+        if self.deadline is not None and now >= self.deadline:
+            return 'latency'
+        return None
+
+    def get_bound(self) -> Optional[str]:
+        """Returns the limit that files of the stream are expected to reach first at the current ingest rate"""
+        if not self.target_size_bytes or not self.max_latency_seconds:
+            return 'size' if self.target_size_bytes else 'latency'
+        if not self.bytes_per_second:
+            return None
+        seconds_to_target = self.target_size_bytes / (self.bytes_per_second * self.compression_ratio)
+        return 'size' if seconds_to_target < self.max_latency_seconds else 'latency'
+
+    def file_flushed(self, reason: str, file: Dict, now: float, upload_seconds: Optional[float] = None) -> Dict:
+        """
+        Learns from an uploaded file of the stream and returns the description of the flush decision
+        """
+        age_seconds = max(now - self.opened_at, 0.0) if self.opened_at is not None else 0.0
+        uncompressed_length = file.get('uncompressed_length') or 0
+
+        if uncompressed_length and file.get('size'):
+            self.compression_ratio = _average(self.compression_ratio, file['size'] / uncompressed_length)
+        if upload_seconds is not None:
+            self.upload_seconds = _average(self.upload_seconds, upload_seconds)
+        # Files closed by the end of the input are cut short, they don't tell the ingest rate
+        if reason != 'end' and age_seconds > 0:
+            self.bytes_per_second = _average(self.bytes_per_second, uncompressed_length / age_seconds)
+            self.records_per_second = _average(self.records_per_second, file.get('record_count', 0) / age_seconds)
+
+        self.flushed_files += 1
+        self.opened_at = None
+        self.deadline = None
+
+        return {
+            'stream': self.stream_name,
+            'reason': reason,
+            'target_key': file['target_key'],
+            'record_count': file.get('record_count'),
+            'uncompressed_length': uncompressed_length,
+            'size': file.get('size'),
+            'age_seconds': round(age_seconds, 3),
+            'upload_seconds': None if upload_seconds is None else round(upload_seconds, 3),
+            'target_size_bytes': self.target_size_bytes,
+            'max_latency_seconds': self.max_latency_seconds,
+            'compression_ratio': round(self.compression_ratio, 4),
+            'bytes_per_second': None if self.bytes_per_second is None else round(self.bytes_per_second, 1),
+            'records_per_second': None if self.records_per_second is None else round(self.records_per_second, 1),
+            'bound': self.get_bound(),
+        }
+
+
+class FlushScheduler:
+    """
+    Flush policies of the streams of a run.
+
+    Streams get a policy if flush_target_file_size_mb or flush_max_latency_seconds
+    is set, globally or for the stream in flush_streams. Files of other streams are
+    uploaded at the end of the run only.
+
+    Every decision is logged as a `flushed_files` singer metric, tagged with the
+    reason, the file stats and the current estimates of the stream.
+    """
+
+    def __init__(self, config: Dict, clock=time.monotonic):
+        self.config = config
+        self.clock = clock
+        self.policies = {}
+        self._next_deadline = None
+
+    def get_policy(self, stream_name) -> Optional[StreamFlushPolicy]:
+        if stream_name not in self.policies:
+            options = get_stream_options(self.config, stream_name)
+            policy = None
+            if options.get('target_file_size_mb') or options.get('max_latency_seconds'):
+                policy = StreamFlushPolicy(stream_name,
+                                           target_file_size_mb=options.get('target_file_size_mb'),
+                                           max_latency_seconds=options.get('max_latency_seconds'),
+                                           compression=self.config.get('compression'))
+            self.policies[stream_name] = policy
+        return self.policies[stream_name]
+
+    def file_opened(self, stream_name):
+        policy = self.get_policy(stream_name)
+        if policy is not None:
+            policy.file_opened(self.clock())
+            if policy.deadline is not None and (self._next_deadline is None or policy.deadline < self._next_deadline):
+                self._next_deadline = policy.deadline
+
+    def get_flush_reason(self, stream_name, bytes_written) -> Optional[str]:
+        """Returns why the current file of the stream should be flushed after a record is written, if it should"""
+        policy = self.policies.get(stream_name)
+        if policy is None or policy.opened_at is None:
+            return None
+        return policy.get_flush_reason(bytes_written, self.clock())
+
+    def get_expired_streams(self) -> List[str]:
+        """Returns the streams whose files reached their latency deadline, checked on every message"""
+        if self._next_deadline is None:
+            return []
+
+        now = self.clock()
+        if now < self._next_deadline:
+            return []
+
+        deadlines = [policy.deadline for policy in self.policies.values()
+                     if policy is not None and policy.deadline is not None]
+        self._next_deadline = min((d for d in deadlines if d > now), default=None)
+        return [stream_name for stream_name, policy in self.policies.items()
+                if policy is not None and policy.deadline is not None and policy.deadline <= now]
+
+    def file_flushed(self, stream_name, reason, file, upload_seconds=None) -> Optional[Dict]:
+        """Records the upload of a file of the stream and emits the decision as metric"""
+        policy = self.policies.get(stream_name)
+        if policy is None:
+            return None
+
+        decision = policy.file_flushed(reason, file, self.clock(), upload_seconds)
+        metrics.log(LOGGER, metrics.Point('counter', 'flushed_files', 1, decision))
+
+        deadlines = [p.deadline for p in self.policies.values() if p is not None and p.deadline is not None]
+        self._next_deadline = min(deadlines, default=None)
+        return decision
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import uuid
+import singer
+
+from typing import Dict, List, Optional, Tuple
+
+LOGGER = singer.get_logger('target_s3_csv')
+
+JOURNAL_PREFIX = 'target-s3-csv-journal-'
+
+
+def get_upload_fingerprint(config: Dict) -> str:
+    """
+    Returns a digest of the settings that decide where and how files are uploaded,
+    so files are resumed only by runs that upload them the same way. The encryption
+    key is part of the digest but it's never written into the journal.
+    """
+    settings = [config.get('s3_bucket'),
+                (config.get('compression') or 'none').lower(),
+                config.get('encryption_type'),
+                config.get('encryption_key')]
+    return hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()
+
+
+class Journal:
+    """
+    Append-only journal in temp_dir of the CSV files written by a run.
+
+    Every file is recorded when it's opened and again with its full
+    description when it's complete and ready to upload. The journal is
+    locked for the lifetime of the run, so other runs sharing the same
+    temp_dir can tell if it belongs to a live process or to a crashed one.
+
+    Complete files are recorded with the upload fingerprint of the run.
+    """
+
+    def __init__(self, temp_dir, upload_fingerprint: Optional[str] = None):
+        self.upload_fingerprint = upload_fingerprint
+        self.path = os.path.join(temp_dir, '{}{}-{}.jsonl'.format(JOURNAL_PREFIX, os.getpid(), uuid.uuid4().hex))
+        self._file = open(self.path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _append(self, entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def file_opened(self, stream, filename, target_key):
+        """Records a new file that's being written"""
+        self._append({'event': 'open', 'stream': stream, 'filename': filename, 'target_key': target_key})
+
+    def file_completed(self, stream, file: Dict):
+        """Records a fully written file, with the description expected by s3.upload_files"""
+        self._append({'event': 'complete', 'stream': stream, 'file': file, 'upload': self.upload_fingerprint})
+
+    def close(self, remove=True):
+        """Releases the journal and removes it once every file of the run has been uploaded"""
+        if self._file.closed:
+            return
+
+        self._file.close()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _remove_derived_files(filename):
+    # Compressed file, deduplication spool and index and sorted runs are all next to the file
+    for path in glob.glob(f'{glob.escape(filename)}.*'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _remove_if_exists(filename):
+    _remove_derived_files(filename)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def _read_entries(journal_file) -> Tuple[List[str], Dict[str, Dict]]:
+    """Returns the opened files and the complete entries by file name of a journal"""
+    opened, completed = [], {}
+    for line in journal_file:
+        try:
+            entry = json.loads(line)
+        except json.decoder.JSONDecodeError:
+            # Last line of a journal of a crashed process might be incomplete
+            continue
+
+        if entry['event'] == 'open':
+            opened.append(entry['filename'])
+        elif entry['event'] == 'complete':
+            completed[entry['file']['filename']] = entry
+
+    return opened, completed
+
+
+def recover(temp_dir, journal: Journal) -> List[Dict]:
+    """
+    Recovers the files left behind in temp_dir by crashed runs.
+
+    Partially written files are deleted. Complete files that still exist
+    locally, i.e. not yet uploaded, are returned with their descriptions so
+    they can be passed to s3.upload_files. Files left over from their upload,
+    like a compressed copy, are deleted as they are created again by the
+    upload. Journals that are locked by live processes, including the given
+    one, are left untouched.
+
+    Complete files of runs with a different upload fingerprint than the given
+    journal, i.e. another bucket, compression or encryption, are not resumed.
+    They are kept in their journal for a run with matching settings.
+
+    The recovered files are taken over by the given journal before removing
+    the journal of the crashed run, so they are recovered again if the
+    current run crashes too before uploading them.
+    """
+    files = []
+    for path in sorted(glob.glob(os.path.join(temp_dir, f'{JOURNAL_PREFIX}*.jsonl'))):
+        with open(path, 'r+', encoding='utf-8') as journal_file:
+            try:
+                fcntl.flock(journal_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                LOGGER.debug("Journal %s belongs to a running process, skipping", path)
+                continue
+
+            opened, completed = _read_entries(journal_file)
+
+            for filename in opened:
+                if filename not in completed:
+                    LOGGER.info("Removing partially written file %s of a previous run", filename)
+                    _remove_if_exists(filename)
+
+            skipped = []
+            for filename, entry in completed.items():
+                file = entry['file']
+                if not os.path.exists(filename):
+                    continue
+
+                if entry.get('upload') != journal.upload_fingerprint:
+                    LOGGER.warning("Not resuming upload of %s of a previous run to %s, it was written with "
+                                   "different bucket, compression or encryption settings",
+                                   filename, file['target_key'])
+                    skipped.append(entry)
+                    continue
+
+                LOGGER.info("Resuming upload of %s of a previous run to %s", filename, file['target_key'])
+                _remove_derived_files(filename)
+                journal.file_completed(entry['stream'], file)
+                files.append(file)
+
+            if skipped:
+                journal_file.seek(0)
+                journal_file.truncate()
+                journal_file.writelines(json.dumps(entry) + '\n' for entry in skipped)
+            else:
+                os.remove(path)
+
+    return files
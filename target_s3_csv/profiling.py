@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import collections
+import contextlib
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import singer
+
+from datetime import datetime
+from typing import Iterator, Optional
+
+LOGGER = singer.get_logger('target_s3_csv')
+
+PROFILE_MODES = ('cprofile', 'sampling')
+
+# Interval of the sampling profiler
+DEFAULT_SAMPLING_INTERVAL = 0.005
+
+
+class CProfiler:
+    """
+    Deterministic profiler writing a pstats file.
+
+    cProfile only sees the thread that enables it, so the thread that starts
+    the profiler and every thread running profile_thread, i.e. the workers of
+    fan-in mode, get their own profile. They are merged into a single file.
+
+    If record_sample_rate is set then only every Nth message is profiled, i.e. the
+    time between yielding the message to persist_messages and reading the next one.
+    """
+
+    extension = 'pstats'
+
+    def __init__(self, record_sample_rate: Optional[int] = None):
+        self.record_sample_rate = record_sample_rate
+        self._profiles = []
+        self._local = threading.local()
+
+    def _get_profile(self) -> cProfile.Profile:
+        """Returns the profile of the current thread"""
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = cProfile.Profile()
+            self._local.profile = profile
+            self._profiles.append(profile)
+        return profile
+
+    def start(self):
+        if not self.record_sample_rate:
+            self._get_profile().enable()
+
+    def stop(self):
+        if not self.record_sample_rate:
+            self._get_profile().disable()
+
+    @contextlib.contextmanager
+    def profile_thread(self):
+        """Profiles the current thread, other than the one that started the profiler"""
+        profile = self._get_profile()
+        if not self.record_sample_rate:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if not self.record_sample_rate:
+                profile.disable()
+
+    def wrap_messages(self, messages) -> Iterator:
+        """Profiles the processing of a sample of the messages only"""
+        if not self.record_sample_rate:
+            yield from messages
+            return
+
+        # Generators run in the thread consuming them
+        profile = self._get_profile()
+        for i, message in enumerate(messages):
+            sampled = i % self.record_sample_rate == 0
+            if sampled:
+                profile.enable()
+            yield message
+            if sampled:
+                profile.disable()
+
+    def dump(self, path):
+        # pstats can't load profiles without any calls, i.e. the main thread in fan-in mode with sampling
+        profiles = [profile for profile in self._profiles if profile.getstats()]
+        if not profiles:
+            cProfile.Profile().dump_stats(path)
+            return
+        pstats.Stats(*profiles).dump_stats(path)
+
+
+class SamplingProfiler:
+    """
+    Low overhead profiler that snapshots the stacks of every thread at a fixed
+    interval and writes them in collapsed stack format, as used by flamegraph
+    tools: one `frame;frame;frame count` line per distinct stack.
+    """
+
+    extension = 'collapsed'
+
+    def __init__(self, interval=DEFAULT_SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own_thread_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if thread_id == own_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sample, name='target-s3-csv-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    @staticmethod
+    def profile_thread():
+        # Stacks of every thread are sampled anyway
+        return contextlib.nullcontext()
+
+    @staticmethod
+    def wrap_messages(messages) -> Iterator:
+        return messages
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as out:
+            for stack, count in self.stacks.most_common():
+                out.write('{} {}\n'.format(stack, count))
+
+
+class Profile:
+    """
+    Context manager profiling a run of the target and writing the profile into
+    profile_dir when the run is finished, even if it failed.
+    """
+
+    def __init__(self, mode, profile_dir, record_sample_rate=None):
+        if mode not in PROFILE_MODES:
+            raise NotImplementedError(
+                "Profile mode '{}' is not supported. Expected one of: {}".format(mode, ', '.join(PROFILE_MODES))
+            )
+
+        self.mode = mode
+        self.profiler = CProfiler(record_sample_rate) if mode == 'cprofile' else SamplingProfiler()
+        self.path = os.path.join(profile_dir, 'target-s3-csv-{}-{}.{}'.format(
+            datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid(), self.profiler.extension))
+        self._started_at = None
+
+    def wrap_messages(self, messages):
+        """Wraps the input messages to profile a sample of them only, if requested"""
+        return self.profiler.wrap_messages(messages)
+
+    def profile_thread(self):
+        """Context manager profiling the work done in a worker thread"""
+        return self.profiler.profile_thread()
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._started_at = time.perf_counter()
+        self.profiler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.stop()
+        self.profiler.dump(self.path)
+        LOGGER.info("Profile of the %.1fs run written to %s", time.perf_counter() - self._started_at, self.path)
+        return False
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import ast
+import operator
+
+from decimal import Decimal
+from typing import Callable, Dict, List
+
+COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+}
+
+
+# Metadata columns are never projected away, they are used by add_metadata_columns
+METADATA_COLUMN_PREFIX = '_sdc_'
+
+
+def project_schema(schema: Dict, columns: List[str]) -> Dict:
+    """Returns a copy of the schema with the selected top level properties only"""
+    selected = set(columns)
+
+    def is_selected(column):
+        return column in selected or column.startswith(METADATA_COLUMN_PREFIX)
+
+    projected = dict(schema)
+    projected['properties'] = {k: v for k, v in (schema.get('properties') or {}).items() if is_selected(k)}
+    if 'required' in schema:
+        projected['required'] = [k for k in schema['required'] if is_selected(k)]
+    return projected
+
+
+def get_missing_columns(columns: List[str], selected_columns: List[str]) -> List[str]:
+    """
+    Returns the columns that are dropped by selecting the given top level columns.
+    Flattened columns of nested properties, i.e. address__city, are kept by selecting their parent.
+    """
+    selected = set(selected_columns)
+    return [column for column in columns
+            if column not in selected
+            and column.split('__', 1)[0] not in selected
+            and not column.startswith(METADATA_COLUMN_PREFIX)]
+
+
+def make_projector(columns: List[str]) -> Callable[[Dict], Dict]:
+    """Returns a function that keeps the selected top level properties of a record only"""
+    selected = set(columns)
+
+    def project(record):
+        return {k: v for k, v in record.items() if k in selected or k.startswith(METADATA_COLUMN_PREFIX)}
+
+    return project
+
+
+def _to_decimal(value):
+    """
+    Turns float literals into Decimal, as singer.parse_message does with the numbers of the records,
+    because Decimal('0.1') == 0.1 is False
+    """
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return type(value)(_to_decimal(item) for item in value)
+    return value
+
+
+def _compile_node(node) -> Callable[[Dict], object]:
+    # pylint: disable=too-many-return-statements
+    if isinstance(node, ast.Expression):
+        return _compile_node(node.body)
+
+    if isinstance(node, ast.Name):
+        name = node.id
+        return lambda record: record.get(name)
+
+    if isinstance(node, ast.Attribute):
+        # Nested properties, i.e. address.city
+        get_parent = _compile_node(node.value)
+        attr = node.attr
+
+        def get_attribute(record):
+            parent = get_parent(record)
+            return parent.get(attr) if isinstance(parent, dict) else None
+
+        return get_attribute
+
+    if isinstance(node, ast.BoolOp):
+        values = [_compile_node(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+            return lambda record: all(value(record) for value in values)
+        return lambda record: any(value(record) for value in values)
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        operand = _compile_node(node.operand)
+        return lambda record: not operand(record)
+
+    if isinstance(node, ast.Compare):
+        left = _compile_node(node.left)
+        comparisons = []
+        for op, comparator in zip(node.ops, node.comparators):
+            if type(op) not in COMPARISONS:
+                raise ValueError("Unsupported comparison: {}".format(type(op).__name__))
+            comparisons.append((COMPARISONS[type(op)], _compile_node(comparator)))
+
+        def compare(record):
+            a = left(record)
+            for op, right in comparisons:
+                b = right(record)
+                try:
+                    if not op(a, b):
+                        return False
+                except TypeError:
+                    # i.e. comparing null with a number
+                    return False
+                a = b
+            return True
+
+        return compare
+
+    try:
+        value = _to_decimal(ast.literal_eval(node))
+    except ValueError:
+        raise ValueError("Unsupported expression: {}".format(ast.dump(node))) from None
+    return lambda record: value
+
+
+def compile_filter(expression: str) -> Callable[[Dict], bool]:
+    """
+    Compiles a filter expression into a function that returns True for the records to keep.
+
+    Expressions use python syntax restricted to record properties, nested
+    properties with dots, literals, comparisons, `in`, `is`, `and`, `or` and
+    `not`, i.e. `status in ('active', 'pending') and amount >= 10`.
+    Nothing is evaluated by python itself, so expressions can't run code.
+    """
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as exc:
+        raise ValueError("Invalid filter expression '{}': {}".format(expression, exc.msg)) from None
+
+    predicate = _compile_node(tree)
+    return lambda record: bool(predicate(record))
@@ -1,21 +1,43 @@
 #!/usr/bin/env python3
 import gzip
+import json
 import os
 import shutil
+import threading
 import backoff
-import boto3
 import singer
 
-from typing import Optional, Tuple, List, Dict, Iterator
-from botocore.client import BaseClient
-from botocore.exceptions import ClientError
+from typing import Optional, Tuple, List, Dict, Iterator, TYPE_CHECKING
+
+from target_s3_csv import utils
+
+if TYPE_CHECKING:
+    from botocore.client import BaseClient
 
 LOGGER = singer.get_logger('target_s3_csv')
 
+# boto3 and botocore take long to import, load them only when S3 is used first
+boto3 = utils.lazy_import('boto3')
+botocore_config = utils.lazy_import('botocore.config')
+botocore_exceptions = utils.lazy_import('botocore.exceptions')
+
+# Size of the connection pool of botocore clients, unless more concurrent uploads are expected
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# Files up to this size are sent in a single PutObject request with a
+# Content-MD5 header. Same as the default multipart threshold of boto3
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+
+def is_not_client_error(exc):
+    """Only AWS client errors are retried"""
+    return not isinstance(exc, botocore_exceptions.ClientError)
+
 
 def retry_pattern():
     return backoff.on_exception(backoff.expo,
-                                ClientError,
+                                Exception,
+                                giveup=is_not_client_error,
                                 max_tries=5,
                                 on_backoff=log_backoff_attempt,
                                 factor=10)
@@ -26,7 +48,11 @@ def log_backoff_attempt(details):
 
 
 @retry_pattern()
-def create_client(config):
+def create_client(config, max_pool_connections=None):
+    """
+    Creates the S3 client. The connection pool of the client holds max_pool_connections
+    connections, so that many threads can upload at the same time without waiting for each other
+    """
     LOGGER.info("Attempting to create AWS session")
 
     # Get the required parameters from config file and/or environment variables
@@ -46,85 +72,242 @@ def create_client(config):
     # AWS Profile based authentication
     else:
         aws_session = boto3.session.Session(profile_name=aws_profile)
+    client_args = {}
     if aws_endpoint_url:
-        s3 = aws_session.client('s3', endpoint_url=aws_endpoint_url)
-    else:
-        s3 = aws_session.client('s3')
-    return s3
+        client_args['endpoint_url'] = aws_endpoint_url
+    if max_pool_connections:
+        client_args['config'] = botocore_config.Config(max_pool_connections=max_pool_connections)
+    return aws_session.client('s3', **client_args)
+
+
+def get_encryption_args(encryption_type=None, encryption_key=None) -> Tuple[Optional[Dict], str]:
+    """
+    Returns the extra S3 arguments and a log friendly description of
+    the requested server side encryption
+    """
+    if encryption_type is None or encryption_type.lower() == "none":
+        # No encryption config (defaults to settings on the bucket):
+        return None, ""
+
+    if encryption_type.lower() == "kms":
+        encryption_args = {"ServerSideEncryption": "aws:kms"}
+        if encryption_key:
+            encryption_desc = (
+                " using KMS encryption key ID '{}'"
+                .format(encryption_key)
+            )
+            encryption_args["SSEKMSKeyId"] = encryption_key
+        else:
+            encryption_desc = " using default KMS encryption"
+        return encryption_args, encryption_desc
+
+    raise NotImplementedError(
+        "Encryption type '{}' is not supported. "
+        "Expected: 'none' or 'KMS'"
+        .format(encryption_type)
+    )
+
+
+class LazyClient:  # pylint: disable=too-few-public-methods
+    """
+    S3 client that's created only when it's used first,
+    so runs without anything to upload don't pay for creating the AWS session
+    """
+
+    def __init__(self, config, max_pool_connections=None):
+        self._config = config
+        self._max_pool_connections = max_pool_connections
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = create_client(self._config, self._max_pool_connections)
+        return getattr(self._client, name)
 
 
 # pylint: disable=too-many-arguments
 @retry_pattern()
 def upload_file(filename, s3_client, bucket, s3_key,
-                encryption_type=None, encryption_key=None):
+                encryption_type=None, encryption_key=None, md5=None):
+    """
+    Uploads a local file to S3.
 
-    if encryption_type is None or encryption_type.lower() == "none":
-        # No encryption config (defaults to settings on the bucket):
-        encryption_desc = ""
-        encryption_args = None
-    else:
-        if encryption_type.lower() == "kms":
-            encryption_args = {"ServerSideEncryption": "aws:kms"}
-            if encryption_key:
-                encryption_desc = (
-                    " using KMS encryption key ID '{}'"
-                    .format(encryption_key)
-                )
-                encryption_args["SSEKMSKeyId"] = encryption_key
-            else:
-                encryption_desc = " using default KMS encryption"
-        else:
-            raise NotImplementedError(
-                "Encryption type '{}' is not supported. "
-                "Expected: 'none' or 'KMS'"
-                .format(encryption_type)
-            )
+    If the MD5 checksum of the file is given then it's stored in the object
+    metadata and files that fit into a single request are sent with a
+    Content-MD5 header, so S3 rejects the upload if the content got corrupted.
+    """
+    encryption_args, encryption_desc = get_encryption_args(encryption_type, encryption_key)
     LOGGER.info(
         "Uploading {} to bucket {} at {}{}"
         .format(filename, bucket, s3_key, encryption_desc)
     )
-    s3_client.upload_file(filename, bucket, s3_key, ExtraArgs=encryption_args)
 
+    if md5 is None:
+        s3_client.upload_file(filename, bucket, s3_key, ExtraArgs=encryption_args)
+        return
 
+    extra_args = {**(encryption_args or {}), 'Metadata': {'md5': md5}}
+    if os.path.getsize(filename) <= MULTIPART_THRESHOLD:
+        with open(filename, 'rb') as f_in:
+            s3_client.put_object(Body=f_in,
+                                 Bucket=bucket,
+                                 Key=s3_key,
+                                 ContentMD5=utils.md5_hex_to_base64(md5),
+                                 **extra_args)
+    else:
+        s3_client.upload_file(filename, bucket, s3_key, ExtraArgs=extra_args)
+
+
+@retry_pattern()
+def is_object_unchanged(s3_client, bucket, s3_key, md5) -> bool:
+    """
+    Returns True if an object exists at the given key and its
+    md5 metadata matches the given checksum.
+
+    Without s3:ListBucket permission S3 answers 403 instead of 404 for
+    missing objects, so forbidden objects are uploaded as if they were missing.
+    """
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=s3_key)
+    except botocore_exceptions.ClientError as exc:
+        code = exc.response.get('Error', {}).get('Code')
+        if code in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        if code in ('403', 'Forbidden', 'AccessDenied'):
+            LOGGER.debug("Not allowed to check s3://%s/%s, uploading it", bucket, s3_key)
+            return False
+        raise
+
+    return response.get('Metadata', {}).get('md5') == md5
+
+
+def compress_file(filename, compressed_file) -> Tuple[str, int]:
+    """
+    Compresses a file with gzip.
+    The gzip header carries no file name nor modification time, so the same
+    content always compresses to the same bytes.
+    Returns the MD5 checksum and the size of the compressed file, computed while writing it.
+    """
+    LOGGER.info("Compressing file as '%s'", compressed_file)
+    with utils.ChecksumFile(open(compressed_file, 'wb')) as checksum_file:
+        with open(filename, 'rb') as f_in:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=checksum_file, mtime=0) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+    return checksum_file.hexdigest(), checksum_file.bytes_written
+
+
+def build_manifest(uploaded_files: List[Dict], s3_bucket: str) -> Dict:
+    """
+    Builds a Redshift COPY compatible manifest of the uploaded files.
+    Row counts, sizes and columns collected while writing the files are added to the meta of every entry.
+    """
+    entries = []
+    for file in uploaded_files:
+        meta = {'content_length': file['size']}
+        for key in ('record_count', 'uncompressed_length', 'columns', 'md5'):
+            if file.get(key) is not None:
+                meta[key] = file[key]
+
+        entries.append({
+            'url': f"s3://{s3_bucket}/{file['target_key']}",
+            'mandatory': True,
+            'meta': meta
+        })
+
+    return {'entries': entries}
+
+
+# pylint: disable=too-many-arguments
+@retry_pattern()
+def upload_manifest(manifest: Dict, s3_client: 'BaseClient', bucket: str, s3_key: str,
+                    encryption_type: Optional[str] = None, encryption_key: Optional[str] = None):
+    """Uploads a manifest as JSON object to S3"""
+    encryption_args, encryption_desc = get_encryption_args(encryption_type, encryption_key)
+    LOGGER.info(
+        "Uploading manifest of {} files to bucket {} at {}{}"
+        .format(len(manifest['entries']), bucket, s3_key, encryption_desc)
+    )
+    s3_client.put_object(Body=json.dumps(manifest, indent=2).encode('utf-8'),
+                         Bucket=bucket,
+                         Key=s3_key,
+                         ContentType='application/json',
+                         **(encryption_args or {}))
+
+
+# pylint: disable=too-many-arguments,too-many-locals
 def upload_files(filenames: Iterator[Dict],
-                 s3_client: BaseClient,
+                 s3_client: 'BaseClient',
                  s3_bucket: str,
                  compression: Optional[str],
                  encryption_type: Optional[str],
-                 encryption_key: Optional[str]):
+                 encryption_key: Optional[str],
+                 skip_unchanged: bool = False,
+                 manifest_key: Optional[str] = None,
+                 manifest_files: Optional[List[Dict]] = None) -> List[Dict]:
     """
     Uploads given local files to s3
     Compress if necessary
+
+    Files with an `md5` checksum are uploaded with integrity check and, if
+    skip_unchanged is set, not uploaded at all when an object with the same
+    key and checksum already exists.
+
+    If manifest_key is given then a manifest listing every uploaded object,
+    after the manifest_files uploaded earlier, is uploaded to that key after the files.
+
+    Returns the list of uploaded objects with their keys, checksums and sizes
     """
+    uploaded_files = []
     for file in filenames:
         filename, target_key = file['filename'], file['target_key']
+        md5 = file.get('md5')
+        size = file.get('uncompressed_length')
         compressed_file = None
 
         if compression is not None and compression.lower() != "none":
             if compression == "gzip":
                 compressed_file = f"{filename}.gz"
                 target_key = f'{target_key}.gz'
-
-                with open(filename, 'rb') as f_in:
-                    with gzip.open(compressed_file, 'wb') as f_out:
-                        LOGGER.info(f"Compressing file as '%s'", compressed_file)
-                        shutil.copyfileobj(f_in, f_out)
+                compressed_md5, size = compress_file(filename, compressed_file)
+                if md5 is not None:
+                    md5 = compressed_md5
 
             else:
                 raise NotImplementedError(
                     "Compression type '{}' is not supported. Expected: 'none' or 'gzip'".format(compression)
                 )
 
-        upload_file(compressed_file or filename,
-                    s3_client,
-                    s3_bucket,
-                    target_key,
-                    encryption_type=encryption_type,
-                    encryption_key=encryption_key
-                    )
+        if size is None:
+            size = os.path.getsize(filename)
+
+        if skip_unchanged and md5 and is_object_unchanged(s3_client, s3_bucket, target_key, md5):
+            LOGGER.info("Skipping upload of %s, s3://%s/%s exists with the same checksum",
+                        filename, s3_bucket, target_key)
+        else:
+            upload_file(compressed_file or filename,
+                        s3_client,
+                        s3_bucket,
+                        target_key,
+                        encryption_type=encryption_type,
+                        encryption_key=encryption_key,
+                        md5=md5
+                        )
+
+        uploaded_files.append({**file, 'target_key': target_key, 'md5': md5, 'size': size})
 
         # Remove the local file(s)
         if os.path.exists(filename):
             os.remove(filename)
             if compressed_file:
                 os.remove(compressed_file)
+
+    if manifest_key:
+        upload_manifest(build_manifest((manifest_files or []) + uploaded_files, s3_bucket),
+                        s3_client, s3_bucket, manifest_key,
+                        encryption_type=encryption_type, encryption_key=encryption_key)
+
+    return uploaded_files
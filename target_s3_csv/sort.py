@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import heapq
+import os
+import pickle
+
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from target_s3_csv import dialects
+
+# Size of the rows buffered in memory before a sorted run is spilled to disk
+DEFAULT_MAX_BYTES_IN_MEMORY = 256 * 1024 * 1024
+
+# Approximate memory used by a buffered row on top of its own bytes
+ROW_OVERHEAD_BYTES = 128
+
+# JSON schema types whose values are ordered numerically
+NUMERIC_TYPES = {'integer', 'number'}
+
+
+def _sort_value(value):
+    """
+    Makes values of any type comparable: numbers are ordered numerically,
+    everything else by its text, and nulls come last
+    """
+    if value is None:
+        return 2, ''
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return 0, value
+    return 1, str(value)
+
+
+def _sort_number(value):
+    """
+    Like _sort_value, but numeric strings are ordered numerically too,
+    as numbers written in fixed point notation by coerce_types are strings
+    """
+    if isinstance(value, str):
+        try:
+            number = Decimal(value)
+        except InvalidOperation:
+            return _sort_value(value)
+        if number.is_finite():
+            return 0, number
+    return _sort_value(value)
+
+
+def make_sort_key(columns: List[str], schema: Optional[Dict] = None) -> Callable[[Dict], Tuple]:
+    """
+    Returns a function that extracts the sort key of a flattened record.
+    If the JSON schema of the stream is given then columns of numeric types
+    are ordered numerically even if their values are strings
+    """
+    column_types = dialects.flatten_schema(schema) if schema else {}
+    sort_values = [(column, _sort_number if column_types.get(column) and set(column_types[column]) <= NUMERIC_TYPES
+                    else _sort_value)
+                   for column in columns]
+
+    def sort_key(record):
+        return tuple(sort_value(record.get(column)) for column, sort_value in sort_values)
+
+    return sort_key
+
+
+def _read_run(path) -> Iterator[Tuple]:
+    with open(path, 'rb') as run:
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+
+class ExternalSorter:
+    """
+    Sorts rows by key with bounded memory.
+
+    Rows are buffered in memory until they reach max_bytes_in_memory, then
+    the buffer is sorted and spilled into a run file next to the CSV file.
+    Sorted rows are returned by a k-way merge of the runs, so streams of any
+    size are sorted while holding at most one buffer in memory. Rows with
+    equal keys keep their arrival order.
+    """
+
+    def __init__(self, path_prefix, max_bytes_in_memory=DEFAULT_MAX_BYTES_IN_MEMORY):
+        self.path_prefix = path_prefix
+        self.max_bytes_in_memory = max_bytes_in_memory
+        self.runs = []
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def add(self, key: Tuple, row: bytes):
+        """Adds a row with its sort key"""
+        self._buffer.append((key, row))
+        self._buffer_bytes += len(row) + ROW_OVERHEAD_BYTES
+        if self._buffer_bytes >= self.max_bytes_in_memory:
+            self._spill()
+
+    def _spill(self):
+        # list.sort is stable, equal keys keep their arrival order
+        self._buffer.sort(key=lambda entry: entry[0])
+        path = '{}.run{}'.format(self.path_prefix, len(self.runs))
+        with open(path, 'wb') as run:
+            for entry in self._buffer:
+                pickle.dump(entry, run, protocol=pickle.HIGHEST_PROTOCOL)
+        self.runs.append(path)
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def rows(self) -> Iterator[bytes]:
+        """Returns every added row in sorted order"""
+        if not self.runs:
+            self._buffer.sort(key=lambda entry: entry[0])
+            return (row for _, row in self._buffer)
+
+        if self._buffer:
+            self._spill()
+
+        # heapq.merge prefers the earlier run on equal keys, so the merge is stable too
+        merged = heapq.merge(*[_read_run(path) for path in self.runs], key=lambda entry: entry[0])
+        return (row for _, row in merged)
+
+    def close(self):
+        """Releases the buffer and removes the run files"""
+        self._buffer = []
+        for path in self.runs:
+            if os.path.exists(path):
+                os.remove(path)
+        self.runs = []
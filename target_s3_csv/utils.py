@@ -1,19 +1,71 @@
 #!/usr/bin/env python3
+import base64
+import hashlib
+import importlib.machinery
+import importlib.util
+import io
+import os
+import sys
 import time
 import singer
 import json
 import re
-import inflection
 
 from decimal import Decimal
 from datetime import datetime
 from collections.abc import MutableMapping
 
+
 logger = singer.get_logger('target_s3_csv')
 
 
+def _find_spec(name):
+    """Finds a module like importlib.util.find_spec, but without importing or loading its parent packages"""
+    parent = name.rpartition('.')[0]
+    if parent in sys.modules:
+        # Reading attributes of lazy modules the usual way would load them
+        parent_spec = object.__getattribute__(sys.modules[parent], '__spec__')
+    elif parent:
+        parent_spec = _find_spec(parent)
+    else:
+        return importlib.util.find_spec(name)
+    return importlib.machinery.PathFinder.find_spec(name, parent_spec.submodule_search_locations)
+
+
+def lazy_import(name):
+    """
+    Returns a module that is loaded only when one of its attributes is accessed first.
+    Keeps the startup fast by not importing heavy modules that a run might not need.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    parent, _, child = name.rpartition('.')
+    parent_module = lazy_import(parent) if parent else None
+
+    spec = _find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    # Submodules have to be attributes of their parent package, as with regular imports
+    if parent:
+        setattr(parent_module, child, module)
+
+    return module
+
+
+inflection = lazy_import('inflection')
+
+
 def validate_config(config):
     """Validates config"""
+    # Modules validate their own options. They're imported here, as some of them depend on utils
+    # pylint: disable=import-outside-toplevel,cyclic-import
+    from target_s3_csv import dialects, flush, profiling, projection
+
     errors = []
     required_config_keys = [
         's3_bucket'
@@ -24,9 +76,44 @@ def validate_config(config):
         if not config.get(k, None):
             errors.append("Required key is missing from config: [{}]".format(k))
 
+    # Check if the record filters are valid expressions
+    for stream_name, expression in (config.get('record_filters') or {}).items():
+        try:
+            projection.compile_filter(expression)
+        except ValueError as exc:
+            errors.append("Invalid record filter of stream [{}]: {}".format(stream_name, exc))
+
+    # Check if the flush policy options are positive numbers
+    errors.extend(flush.validate_options(config))
+
+    # Check if the CSV dialect is known and its overrides are valid
+    errors.extend(dialects.validate_options(config))
+
+    # Check if the profile mode is known
+    if config.get('profile') not in (None, False, True) + profiling.PROFILE_MODES:
+        errors.append("Unknown profile mode: [{}]. Expected one of: {}".format(config['profile'],
+                                                                              ', '.join(profiling.PROFILE_MODES)))
+    sample_rate = config.get('profile_record_sample_rate')
+    if sample_rate is not None and (isinstance(sample_rate, bool) or not isinstance(sample_rate, int)
+                                    or sample_rate < 1):
+        errors.append("Invalid profile_record_sample_rate: [{}]. Expected a positive integer".format(sample_rate))
+
     return errors
 
 
+def get_sort_columns(config, stream_name, key_properties):
+    """
+    Returns the columns to sort the output of a stream by: the columns configured
+    for the stream in sort_columns or, if sort_records is enabled, its key properties
+    """
+    sort_columns = (config.get('sort_columns') or {}).get(stream_name)
+    if sort_columns:
+        return sort_columns
+    if config.get('sort_records'):
+        return key_properties or None
+    return None
+
+
 def float_to_decimal(value):
     """Walk the given data structure and turn all instances of float into
     double."""
@@ -122,10 +209,12 @@ def flatten_record(d, parent_key=None, sep='__'):
     return dict(items)
 
 
-def get_target_key(message, prefix=None, timestamp=None, naming_convention=None):
+# pylint: disable=too-many-arguments
+def get_target_key(message, prefix=None, timestamp=None, naming_convention=None, source=None, part=0):
     """Creates and returns an S3 key for the message"""
     if not naming_convention:
-        naming_convention = '{stream}-{timestamp}.csv' # o['stream'] + '-' + now + '.csv'
+        # Streams of different sources in fan-in mode must not overwrite each other
+        naming_convention = '{stream}-{source}-{timestamp}.csv' if source else '{stream}-{timestamp}.csv'
     if not timestamp:
         timestamp = datetime.now().strftime('%Y%m%dT%H%M%S')
     key = naming_convention
@@ -134,11 +223,17 @@ def get_target_key(message, prefix=None, timestamp=None, naming_convention=None)
     for k, v in {
         '{stream}': message['stream'],
         '{timestamp}': timestamp,
-        '{date}': datetime.now().strftime('%Y-%m-%d')
+        '{date}': datetime.now().strftime('%Y-%m-%d'),
+        '{source}': source or '',
+        '{part}': str(part)
     }.items():
         if k in key:
             key = key.replace(k, v)
 
+    # Files of a stream flushed during the run must not overwrite each other
+    if part and '{part}' not in naming_convention:
+        key = add_part_suffix(key, part)
+
     # replace dynamic tokens
     # todo: replace dynamic tokens such as {date(<format>)} with the date formatted as requested in <format>
 
@@ -146,3 +241,49 @@ def get_target_key(message, prefix=None, timestamp=None, naming_convention=None)
         filename = key.split('/')[-1]
         key = key.replace(filename, f'{prefix}{filename}')
     return key
+
+
+def add_part_suffix(path, part):
+    """Adds the part number of a file before the extension of its name, i.e. stream.csv -> stream-1.csv"""
+    name, extension = os.path.splitext(path)
+    return f'{name}-{part}{extension}'
+
+
+class ChecksumFile(io.RawIOBase):
+    """Write-only file object that computes the MD5 checksum and the size of
+    every byte passing through it, so files can be hashed while they are
+    being written instead of reading them back afterwards."""
+
+    def __init__(self, fileobj):
+        super().__init__()
+        self._fileobj = fileobj
+        self._md5 = hashlib.md5()
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._md5.update(b)
+        self.bytes_written += len(b)
+        return self._fileobj.write(b)
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def fileno(self):
+        return self._fileobj.fileno()
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self._fileobj.close()
+
+    def hexdigest(self):
+        """MD5 checksum of the written bytes as hex string"""
+        return self._md5.hexdigest()
+
+
+def md5_hex_to_base64(md5_hex):
+    """Converts a hex MD5 digest to the base64 format used by the Content-MD5 header"""
+    return base64.b64encode(bytes.fromhex(md5_hex)).decode('ascii')
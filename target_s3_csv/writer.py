@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+import csv
+import io
+import os
+import pickle
+import singer
+
+from typing import Iterator
+
+from target_s3_csv import dedup
+from target_s3_csv import dialects
+from target_s3_csv import sort
+from target_s3_csv import utils
+
+LOGGER = singer.get_logger('target_s3_csv')
+
+
+class StreamWriter:
+    """
+    Writes the flattened records of a single stream into a local CSV file.
+
+    The file is kept open for the lifetime of the writer and every byte is
+    passed through a ChecksumFile, so the MD5 checksum of the file is known
+    as soon as it's closed, without reading the file back.
+
+    If a named dialect is given then the rows are encoded by the column
+    encoders compiled from the stream schema instead of csv.DictWriter.
+
+    If key_properties are given then the rows are deduplicated: every row is
+    appended to a spool file, a KeyIndex keeps the position of the latest
+    row of every key and only these rows are copied into the CSV file when
+    the writer is closed.
+
+    If sort_columns are given then the rows are passed through an
+    ExternalSorter and written into the CSV file in sorted order when the
+    writer is closed. Deduplicated rows are sorted after deduplication.
+    Columns of numeric types in the schema are sorted numerically, even if
+    their values were coerced into strings.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes,too-many-locals
+    def __init__(self, filename, target_key, delimiter=',', quotechar='"', dialect=None, encoders=None,
+                 key_properties=None, max_keys_in_memory=dedup.DEFAULT_MAX_KEYS_IN_MEMORY,
+                 sort_columns=None, sort_max_bytes_in_memory=sort.DEFAULT_MAX_BYTES_IN_MEMORY, schema=None):
+        self.filename = filename
+        self.target_key = target_key
+        self.dialect = dialect
+        self.encoders = encoders
+        self.delimiter = dialect['delimiter'] if dialect else delimiter
+        self.quotechar = dialect['quotechar'] if dialect else quotechar
+        self.key_properties = key_properties or None
+        self.max_keys_in_memory = max_keys_in_memory
+        self.sort_columns = sort_columns or None
+        self.sort_max_bytes_in_memory = sort_max_bytes_in_memory
+        self.schema = schema
+        self.headers = None
+        self.record_count = 0
+
+        self._file = None
+        self._checksum_file = None
+        self._writer = None
+        self._encode_row = None
+
+        self._spool = None
+        self._spool_offset = 0
+        self._spooled_rows = 0
+        self._buffered_bytes = 0
+        self._index = None
+        self._sorter = None
+        self._sort_key = None
+
+    def _get_row_formatter(self):
+        """Returns a function that formats a record as a CSV line, without writing it"""
+        if self.dialect:
+            return self._encode_row
+
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer,
+                                self.headers,
+                                extrasaction='ignore',
+                                delimiter=self.delimiter,
+                                quotechar=self.quotechar)
+
+        def format_row(record):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(record)
+            return buffer.getvalue()
+
+        return format_row
+
+    def _open(self, record):
+        self.headers = list(record.keys())
+
+        if self.dialect:
+            encoders = self.encoders or dialects.build_column_encoders({}, self.dialect)
+            self._encode_row = dialects.build_row_encoder(self.headers, encoders, self.dialect)
+
+        if not self.key_properties and not self.sort_columns:
+            self._open_file()
+            return
+
+        # Rows are written into the CSV file only when the writer is closed
+        self._encode_row = self._get_row_formatter()
+        self._writer = self._encode_row
+
+        if self.sort_columns:
+            self._sorter = sort.ExternalSorter(self.filename, self.sort_max_bytes_in_memory)
+            self._sort_key = sort.make_sort_key(self.sort_columns, self.schema)
+
+        if self.key_properties:
+            # Closed when the deduplicated rows are read back
+            self._spool = open(f'{self.filename}.spool', 'wb')  # pylint: disable=consider-using-with
+            self._index = dedup.KeyIndex(f'{self.filename}.index', self.max_keys_in_memory)
+
+    def _open_file(self):
+        """Opens the CSV file and writes its header"""
+        # Closed by close(), the file is written across many calls
+        self._checksum_file = utils.ChecksumFile(open(self.filename, 'wb'))  # pylint: disable=consider-using-with
+        self._file = io.TextIOWrapper(io.BufferedWriter(self._checksum_file), encoding='utf-8', newline='')
+
+        if self.dialect:
+            self._writer = self._file
+            self._file.write(dialects.encode_header(self.headers, self.dialect))
+        else:
+            self._writer = csv.DictWriter(self._file,
+                                          self.headers,
+                                          extrasaction='ignore',
+                                          delimiter=self.delimiter,
+                                          quotechar=self.quotechar)
+            self._writer.writeheader()
+
+    def write(self, record):
+        """Appends a flattened record to the CSV file"""
+        if self._writer is None:
+            self._open(record)
+
+        if self._spool is not None:
+            row = self._encode_row(record).encode('utf-8')
+            self._buffered_bytes += len(row)
+            # The sort key can't be recovered from the encoded row, it's spooled together with the row
+            if self._sorter is not None:
+                row = pickle.dumps((self._sort_key(record), row), protocol=pickle.HIGHEST_PROTOCOL)
+            self._spool.write(row)
+            self._index.add(dedup.get_key(record, self.key_properties), self._spool_offset, len(row))
+            self._spool_offset += len(row)
+            self._spooled_rows += 1
+        elif self._sorter is not None:
+            row = self._encode_row(record).encode('utf-8')
+            self._buffered_bytes += len(row)
+            self._sorter.add(self._sort_key(record), row)
+        elif self._encode_row:
+            self._writer.write(self._encode_row(record))
+            self.record_count += 1
+        else:
+            self._writer.writerow(record)
+            self.record_count += 1
+
+    @property
+    def bytes_written(self) -> int:
+        """
+        Approximate size of the CSV file so far. Rows that are deduplicated or
+        sorted before they are written into the file are counted as they come,
+        rows written directly are counted once they leave the write buffers.
+        """
+        if self._checksum_file is not None:
+            return self._checksum_file.bytes_written
+        return self._buffered_bytes
+
+    def _deduplicated_rows(self) -> Iterator[bytes]:
+        """Returns the latest row of every key from the spool file, in arrival order"""
+        self._spool.close()
+
+        with open(self._spool.name, 'rb') as spool:
+            for offset, length in self._index.positions():
+                spool.seek(offset)
+                yield spool.read(length)
+
+        os.remove(self._spool.name)
+        self._index.close()
+        self._spool = None
+        self._index = None
+
+    def _write_rows(self):
+        """Writes the deduplicated and/or sorted rows into the CSV file"""
+        rows = self._deduplicated_rows() if self._spool is not None else None
+
+        if self._sorter is not None:
+            if rows is not None:
+                for row in rows:
+                    self._sorter.add(*pickle.loads(row))
+            rows = self._sorter.rows()
+
+        self._open_file()
+        self._file.flush()
+        for row in rows:
+            self._file.buffer.write(row)
+            self.record_count += 1
+
+        if self._spooled_rows:
+            LOGGER.info("Deduplicated %d rows into %d rows in %s",
+                        self._spooled_rows, self.record_count, self.filename)
+
+        if self._sorter is not None:
+            LOGGER.info("Sorted %d rows of %s by %s using %d runs on disk",
+                        self.record_count, self.filename, ', '.join(self.sort_columns), len(self._sorter.runs))
+            self._sorter.close()
+            self._sorter = None
+
+    def close(self):
+        """
+        Closes the CSV file and returns its description, as expected by s3.upload_files,
+        with the checksum and the stats collected while writing
+        """
+        if self._spool is not None or self._sorter is not None:
+            self._write_rows()
+
+        file = {
+            'filename': self.filename,
+            'target_key': self.target_key,
+            'record_count': self.record_count,
+            'columns': list(self.headers or []),
+        }
+
+        if self._file is not None:
+            # Make sure the content is on disk before the file is journaled as complete
+            self._file.flush()
+            os.fsync(self._checksum_file.fileno())
+            self._file.close()
+            file['md5'] = self._checksum_file.hexdigest()
+            file['uncompressed_length'] = self._checksum_file.bytes_written
+            self._file = None
+            self._writer = None
+            self._encode_row = None
+
+        return file
@@ -0,0 +1,64 @@
+"""
+Benchmark of the schema compiled type coercion against passing records through
+
+Run with: python -m tests.benchmark.bench_coercion
+"""
+import copy
+import time
+
+from decimal import Decimal
+
+from target_s3_csv import coercion
+from target_s3_csv import utils
+
+SCHEMA = {
+    'properties': {
+        'id': {'type': ['integer']},
+        'name': {'type': ['null', 'string']},
+        'email': {'type': ['null', 'string']},
+        'price': {'type': ['null', 'number'], 'multipleOf': 0.01},
+        'active': {'type': ['null', 'boolean']},
+        'created_at': {'type': ['null', 'string'], 'format': 'date-time'},
+        'updated_at': {'type': ['null', 'string'], 'format': 'date-time'},
+        'payload': {'type': ['null', 'object']},
+    }
+}
+
+RECORD = {
+    'id': 1,
+    'name': 'John Doe',
+    'email': 'john@example.com',
+    'price': Decimal('12.5'),
+    'active': True,
+    'created_at': '2020-01-31T12:20:30+02:00',
+    'updated_at': '2020-01-31T12:20:30.123456Z',
+    'payload': {'a': 1, 'b': [1, 2, 3]},
+}
+
+NUMBER_OF_RECORDS = 100000
+
+
+def run(coerce, repeat=3):
+    """Best time of coercing and flattening fresh copies of the records"""
+    timings = []
+    for _ in range(repeat):
+        records = [copy.deepcopy(RECORD) for _ in range(NUMBER_OF_RECORDS)]
+        start = time.perf_counter()
+        for record in records:
+            utils.flatten_record(coerce(record))
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main():
+    passthrough = run(lambda record: record)
+    coerced = run(coercion.build_record_coercer(SCHEMA))
+
+    print('{} records'.format(NUMBER_OF_RECORDS))
+    print('passthrough + flatten: {:.3f}s'.format(passthrough))
+    print('coercion + flatten:    {:.3f}s ({:+.0%})'.format(coerced, coerced / passthrough - 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import unittest
+
+from decimal import Decimal
+
+from target_s3_csv import coercion
+from target_s3_csv import utils
+
+
+class TestCoercion(unittest.TestCase):
+    """
+    Unit Tests for coercion module
+    """
+
+    def setUp(self) -> None:
+        self.schema = {
+            'properties': {
+                'id': {'type': ['integer']},
+                'price': {'type': ['null', 'number'], 'multipleOf': 0.01},
+                'ratio': {'type': ['null', 'number']},
+                'active': {'type': ['null', 'boolean']},
+                'name': {'type': ['null', 'string']},
+                'created_at': {'type': ['null', 'string'], 'format': 'date-time'},
+                'birthday': {'type': ['null', 'string'], 'format': 'date'},
+                'payload': {'type': ['null', 'object']},
+                'address': {
+                    'type': ['null', 'object'],
+                    'properties': {
+                        'updated_at': {'type': ['null', 'string'], 'format': 'date-time'},
+                        'city': {'type': ['null', 'string']},
+                    }
+                },
+            }
+        }
+
+    def test_coerce_record(self):
+        """Test every coercion compiled from the schema"""
+        coerce = coercion.build_record_coercer(self.schema)
+        record = coerce({
+            'id': '42',
+            'price': Decimal('1.005'),
+            'ratio': Decimal('1E+2'),
+            'active': 'Yes',
+            'name': ' 01 ',
+            'created_at': '2020-01-31T12:20:30+02:00',
+            'birthday': '2020-01-31T00:00:00Z',
+            'payload': {'b': [1, 2], 'a': None},
+            'address': {'updated_at': '2020-01-31 10:20:30', 'city': 'London'},
+            'not_in_schema': '2020',
+        })
+
+        self.assertEqual({
+            'id': 42,
+            'price': '1.01',
+            'ratio': '100',
+            'active': True,
+            'name': ' 01 ',
+            'created_at': '2020-01-31T10:20:30.000000Z',
+            'birthday': '2020-01-31',
+            'payload': '{"b":[1,2],"a":null}',
+            'address': {'updated_at': '2020-01-31T10:20:30.000000Z', 'city': 'London'},
+            'not_in_schema': '2020',
+        }, record)
+
+        # JSON columns are not flattened
+        self.assertEqual(['active', 'address__city', 'address__updated_at', 'birthday', 'created_at', 'id',
+                          'name', 'not_in_schema', 'payload', 'price', 'ratio'],
+                         list(utils.flatten_record(record).keys()))
+
+    def test_invalid_values_are_passed_through(self):
+        """Values that can't be coerced are left for the loader to reject"""
+        coerce = coercion.build_record_coercer(self.schema)
+        record = {'id': '4.2', 'price': 'n/a', 'active': 'maybe', 'created_at': 'yesterday noon-ish', 'birthday': None}
+
+        self.assertEqual({'id': '4.2', 'price': 'n/a', 'active': 'maybe', 'created_at': 'yesterday noon-ish',
+                          'birthday': None},
+                         coerce(dict(record)))
+
+        for value in ('Infinity', '-inf', 'NaN', 'sNaN'):
+            self.assertEqual({'id': value, 'price': value}, coerce({'id': value, 'price': value}))
+
+    def test_numbers_are_rounded_half_up(self):
+        coerce_number = coercion.make_coerce_number(2)
+
+        self.assertEqual(['1.01', '1.00', '-1.01', '2.50'],
+                         [coerce_number(value) for value in ('1.005', 1.004, '-1.005', 2.5)])
+
+    def test_schema_without_coercions(self):
+        """Records of schemas with string properties only are returned untouched"""
+        coerce = coercion.build_record_coercer({'properties': {'name': {'type': 'string'}}})
+        record = {'name': 'a'}
+
+        self.assertIs(record, coerce(record))
+
+    def test_get_scale(self):
+        self.assertEqual(2, coercion.get_scale(0.01))
+        self.assertEqual(0, coercion.get_scale(1))
+        self.assertEqual(38, coercion.get_scale(Decimal('1e-38')))
+        self.assertIsNone(coercion.get_scale(None))
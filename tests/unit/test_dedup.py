@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from target_s3_csv import dedup
+from target_s3_csv.writer import StreamWriter
+
+
+class TestDedup(unittest.TestCase):
+    """
+    Unit Tests for dedup module
+    """
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_get_key(self):
+        """Keys are compact digests of the key properties only"""
+        key = dedup.get_key({'id': 1, 'name': 'a'}, ['id'])
+
+        self.assertEqual(16, len(key))
+        self.assertEqual(key, dedup.get_key({'id': 1, 'name': 'b'}, ['id']))
+        self.assertNotEqual(key, dedup.get_key({'id': 2, 'name': 'a'}, ['id']))
+        self.assertNotEqual(dedup.get_key({'a': '1', 'b': '23'}, ['a', 'b']),
+                            dedup.get_key({'a': '12', 'b': '3'}, ['a', 'b']))
+
+    def test_key_index_in_memory(self):
+        index = dedup.KeyIndex(os.path.join(self.temp_dir.name, 'index'))
+        index.add(b'a', 0, 10)
+        index.add(b'b', 10, 5)
+        index.add(b'a', 15, 7)
+
+        self.assertEqual([(10, 5), (15, 7)], list(index.positions()))
+        self.assertFalse(os.path.exists(index.path))
+        index.close()
+
+    def test_key_index_spills_to_disk(self):
+        """The latest position wins across spills"""
+        index = dedup.KeyIndex(os.path.join(self.temp_dir.name, 'index'), max_keys_in_memory=2)
+        index.add(b'a', 0, 1)
+        index.add(b'b', 1, 1)
+        self.assertTrue(os.path.exists(index.path))
+        index.add(b'c', 2, 1)
+        index.add(b'a', 3, 1)
+        index.add(b'c', 4, 1)
+
+        self.assertEqual([(1, 1), (3, 1), (4, 1)], list(index.positions()))
+        index.close()
+        self.assertFalse(os.path.exists(index.path))
+
+    def test_stream_writer_keeps_latest_row_per_key(self):
+        filename = os.path.join(self.temp_dir.name, 'stream.csv')
+        writer = StreamWriter(filename, 'stream.csv', key_properties=['id'], max_keys_in_memory=2)
+        for record in ({'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b,c'}, {'id': 1, 'name': 'd'},
+                       {'id': 3, 'name': 'e\nf'}, {'id': 2, 'name': 'g'}):
+            writer.write(record)
+        file = writer.close()
+
+        with open(filename, 'rb') as csvfile:
+            self.assertEqual(b'id,name\r\n1,d\r\n3,"e\nf"\r\n2,g\r\n', csvfile.read())
+        self.assertEqual(3, file['record_count'])
+        self.assertEqual(['stream.csv'], os.listdir(self.temp_dir.name))
@@ -0,0 +1,93 @@
+import unittest
+
+from decimal import Decimal
+
+from target_s3_csv import dialects
+from target_s3_csv import utils
+
+
+class TestDialects(unittest.TestCase):
+    """
+    Unit Tests for dialects module
+    """
+
+    def setUp(self) -> None:
+        self.schema = {
+            'properties': {
+                'id': {'type': 'integer'},
+                'price': {'type': ['null', 'number']},
+                'active': {'type': ['null', 'boolean']},
+                'name': {'type': ['null', 'string']},
+                'tags': {'type': ['null', 'array']},
+                'address': {
+                    'type': ['null', 'object'],
+                    'properties': {
+                        'city': {'type': ['null', 'string']},
+                    }
+                },
+            }
+        }
+        self.headers = ['active', 'address__city', 'id', 'name', 'price', 'tags']
+
+    def encode(self, dialect_name, record):
+        dialect = dialects.get_dialect(dialect_name)
+        encoders = dialects.build_column_encoders(self.schema, dialect)
+        encode_row = dialects.build_row_encoder(self.headers, encoders, dialect)
+        return encode_row(utils.flatten_record(record))
+
+    def test_flatten_schema(self):
+        """Test that the flattened schema columns match the columns of flattened records"""
+        self.assertEqual({
+            'id': ['integer'],
+            'price': ['number'],
+            'active': ['boolean'],
+            'name': ['string'],
+            'tags': ['array'],
+            'address__city': ['string'],
+        }, dialects.flatten_schema(self.schema))
+
+    def test_unknown_dialect(self):
+        """Test that unknown dialects are rejected"""
+        with self.assertRaises(NotImplementedError):
+            dialects.get_dialect('excel')
+
+        self.assertGreater(len(utils.validate_config({'s3_bucket': 'b', 'csv_dialect': 'excel'})), 0)
+        self.assertEqual(len(utils.validate_config({'s3_bucket': 'b', 'csv_dialect': 'redshift'})), 0)
+
+    def test_invalid_escapechar(self):
+        """Test that escapechar must be a single character that doesn't clash with the other special characters"""
+        for escapechar in ('', '\\\\', 1, '"', '|', '\n'):
+            self.assertEqual(1, len(utils.validate_config({'s3_bucket': 'b', 'csv_dialect': 'redshift',
+                                                               'delimiter': '|', 'escapechar': escapechar})),
+                             escapechar)
+        self.assertEqual(0, len(utils.validate_config({'s3_bucket': 'b', 'csv_dialect': 'redshift',
+                                                           'escapechar': '\\'})))
+
+    def test_redshift_dialect(self):
+        """Test nulls, booleans, quoting and newlines of the redshift dialect"""
+        record = {'id': 1, 'price': Decimal('1.50'), 'active': True, 'name': 'Say "hi",\nplease',
+                  'tags': ['a', 'b'], 'address': {'city': None}}
+
+        self.assertEqual('true,\\N,1,"Say ""hi"",\nplease",1.50,"[""a"", ""b""]"\n',
+                         self.encode('redshift', record))
+
+    def test_snowflake_dialect_distinguishes_null_and_empty_string(self):
+        """Test that null values are unquoted and every other value is quoted"""
+        record = {'id': 1, 'price': None, 'active': False, 'name': '', 'tags': None, 'address': {'city': 'London'}}
+
+        self.assertEqual('"false","London","1","",,\n', self.encode('snowflake', record))
+
+    def test_rfc4180_dialect(self):
+        """Test line terminator, quoting of null like strings and values not matching the schema"""
+        record = {'id': 'not-a-number', 'price': 2.5, 'active': None, 'name': '', 'tags': [],
+                  'address': {'city': 'a,b'}}
+
+        self.assertEqual(',"a,b",not-a-number,"",2.5,[]\r\n', self.encode('rfc4180', record))
+
+    def test_escapechar(self):
+        """Test that escapechar escapes quotes instead of doubling them"""
+        dialect = dialects.get_dialect('rfc4180', delimiter='|', escapechar='\\')
+        encoders = dialects.build_column_encoders(self.schema, dialect)
+        encode_row = dialects.build_row_encoder(['id', 'name'], encoders, dialect)
+
+        self.assertEqual('1|"a\\"|\\\\b"\r\n', encode_row({'id': 1, 'name': 'a"|\\b'}))
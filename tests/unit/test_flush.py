@@ -0,0 +1,96 @@
+import unittest
+
+from unittest.mock import patch
+
+from target_s3_csv import flush
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestFlush(unittest.TestCase):
+    """
+    Unit Tests for flush module
+    """
+
+    def test_get_stream_options(self):
+        """Options of a stream override the global options"""
+        config = {'flush_target_file_size_mb': 64, 'flush_max_latency_seconds': 300,
+                  'flush_streams': {'slow': {'max_latency_seconds': 3600}, 'unlimited': {'max_latency_seconds': None}}}
+
+        self.assertEqual({'target_file_size_mb': 64, 'max_latency_seconds': 300},
+                         flush.get_stream_options(config, 'other'))
+        self.assertEqual({'target_file_size_mb': 64, 'max_latency_seconds': 3600},
+                         flush.get_stream_options(config, 'slow'))
+        self.assertEqual({'target_file_size_mb': 64, 'max_latency_seconds': None},
+                         flush.get_stream_options(config, 'unlimited'))
+
+    def test_validate_options(self):
+        self.assertEqual([], flush.validate_options({'flush_target_file_size_mb': 0.5,
+                                                     'flush_streams': {'s': {'max_latency_seconds': 60}}}))
+        self.assertEqual(3, len(flush.validate_options({'flush_target_file_size_mb': -1,
+                                                        'flush_max_latency_seconds': 'soon',
+                                                        'flush_streams': {'s': {'max_records': 10}}})))
+
+    def test_flush_by_size_learns_compression_ratio(self):
+        policy = flush.StreamFlushPolicy('s', target_file_size_mb=1, compression='gzip')
+        policy.file_opened(0.0)
+
+        # gzip files are assumed to compress to a quarter until the first one is uploaded
+        self.assertIsNone(policy.get_flush_reason(3 * 1024 * 1024, 10.0))
+        self.assertEqual('size', policy.get_flush_reason(4 * 1024 * 1024, 10.0))
+
+        decision = policy.file_flushed('size', {'target_key': 'k', 'record_count': 100,
+                                                'uncompressed_length': 4 * 1024 * 1024, 'size': 512 * 1024}, 10.0)
+
+        self.assertEqual(0.1875, decision['compression_ratio'])
+        self.assertEqual(419430.4, decision['bytes_per_second'])
+        self.assertEqual(10.0, decision['records_per_second'])
+        self.assertEqual('size', decision['bound'])
+
+    def test_flush_by_latency_leaves_time_to_upload(self):
+        policy = flush.StreamFlushPolicy('s', max_latency_seconds=60)
+        policy.file_opened(0.0)
+        self.assertIsNone(policy.get_flush_reason(10, 59.0))
+        self.assertEqual('latency', policy.get_flush_reason(10, 60.0))
+
+        policy.file_flushed('latency', {'target_key': 'k', 'uncompressed_length': 10}, 60.0, upload_seconds=20.0)
+        policy.file_opened(100.0)
+        self.assertEqual('latency', policy.get_flush_reason(10, 140.0))
+
+        # Slow uploads never leave less than a tenth of the latency for buffering
+        policy.file_flushed('latency', {'target_key': 'k', 'uncompressed_length': 10}, 140.0, upload_seconds=500.0)
+        policy.file_opened(200.0)
+        self.assertIsNone(policy.get_flush_reason(10, 205.0))
+        self.assertEqual('latency', policy.get_flush_reason(10, 206.0))
+
+    def test_scheduler(self):
+        """Only streams with options get a policy and expired streams are found on any message"""
+        clock = FakeClock()
+        scheduler = flush.FlushScheduler({'flush_streams': {'a': {'max_latency_seconds': 10},
+                                                            'b': {'max_latency_seconds': 20}}}, clock=clock)
+        for stream_name in ('a', 'b', 'c'):
+            scheduler.file_opened(stream_name)
+
+        self.assertIsNone(scheduler.get_policy('c'))
+        self.assertIsNone(scheduler.get_flush_reason('c', 10 ** 9))
+        self.assertEqual([], scheduler.get_expired_streams())
+
+        clock.now = 15.0
+        self.assertEqual(['a'], scheduler.get_expired_streams())
+
+        with patch('target_s3_csv.flush.metrics.log') as log:
+            decision = scheduler.file_flushed('a', 'latency', {'target_key': 'a.csv', 'uncompressed_length': 10})
+
+        self.assertEqual('latency', decision['reason'])
+        self.assertEqual('flushed_files', log.call_args[0][1].metric)
+        self.assertEqual(decision, log.call_args[0][1].tags)
+        self.assertEqual([], scheduler.get_expired_streams())
+
+        clock.now = 20.0
+        self.assertEqual(['b'], scheduler.get_expired_streams())
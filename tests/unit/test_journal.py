@@ -0,0 +1,111 @@
+import glob
+import json
+import os
+import tempfile
+import unittest
+
+from target_s3_csv import journal
+
+
+class TestJournal(unittest.TestCase):
+    """
+    Unit Tests for journal module
+    """
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = self.temp_dir.name
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def touch(self, name):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'w') as f:
+            f.write('id\n1\n')
+        return filename
+
+    def test_close_removes_journal(self):
+        """Journal of a successful run doesn't stay in temp_dir"""
+        run_journal = journal.Journal(self.dir)
+        run_journal.file_opened('s1', os.path.join(self.dir, 'a.csv'), 'a.csv')
+        run_journal.close()
+
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_recover_files_of_crashed_run(self):
+        """Partial files are deleted, complete files are returned and taken over by the current journal"""
+        partial = self.touch('partial.csv')
+        complete = self.touch('complete.csv')
+        uploaded = os.path.join(self.dir, 'uploaded.csv')
+
+        crashed_journal = journal.Journal(self.dir)
+        for filename in (partial, complete, uploaded):
+            crashed_journal.file_opened('s1', filename, os.path.basename(filename))
+        crashed_journal.file_completed('s1', {'filename': complete, 'target_key': 'complete.csv', 'md5': 'x'})
+        crashed_journal.file_completed('s1', {'filename': uploaded, 'target_key': 'uploaded.csv', 'md5': 'y'})
+        # Simulate a crash: the lock is released but the journal stays
+        crashed_journal.close(remove=False)
+
+        run_journal = journal.Journal(self.dir)
+        files = journal.recover(self.dir, run_journal)
+
+        self.assertEqual([{'filename': complete, 'target_key': 'complete.csv', 'md5': 'x'}], files)
+        self.assertFalse(os.path.exists(partial))
+        self.assertTrue(os.path.exists(complete))
+        self.assertFalse(os.path.exists(crashed_journal.path))
+
+        # The recovered file is in the journal of the current run
+        with open(run_journal.path) as journal_file:
+            entries = [json.loads(line) for line in journal_file]
+        self.assertEqual([{'event': 'complete', 'stream': 's1', 'file': files[0], 'upload': None}], entries)
+        run_journal.close()
+
+    def test_recover_files_with_matching_upload_settings_only(self):
+        """Files are resumed only by runs uploading to the same bucket with the same compression and encryption"""
+        config_a = {'s3_bucket': 'bucket-A', 'compression': 'gzip'}
+        config_b = {'s3_bucket': 'bucket-B', 'compression': 'gzip'}
+        complete = self.touch('complete.csv')
+        compressed = self.touch('complete.csv.gz')
+
+        crashed_journal = journal.Journal(self.dir, journal.get_upload_fingerprint(config_a))
+        crashed_journal.file_opened('s1', complete, 'complete.csv')
+        crashed_journal.file_completed('s1', {'filename': complete, 'target_key': 'complete.csv'})
+        crashed_journal.close(remove=False)
+
+        other_journal = journal.Journal(self.dir, journal.get_upload_fingerprint(config_b))
+        self.assertEqual([], journal.recover(self.dir, other_journal))
+        other_journal.close()
+        self.assertTrue(os.path.exists(complete))
+        self.assertTrue(os.path.exists(crashed_journal.path))
+
+        run_journal = journal.Journal(self.dir, journal.get_upload_fingerprint(config_a))
+        self.assertEqual([{'filename': complete, 'target_key': 'complete.csv'}],
+                         journal.recover(self.dir, run_journal))
+        run_journal.close()
+        self.assertFalse(os.path.exists(compressed))
+        self.assertFalse(os.path.exists(crashed_journal.path))
+
+    def test_upload_fingerprint(self):
+        fingerprint = journal.get_upload_fingerprint({'s3_bucket': 'b', 'encryption_key': 'secret'})
+
+        self.assertEqual(fingerprint, journal.get_upload_fingerprint({'s3_bucket': 'b', 'compression': 'None',
+                                                                      'encryption_key': 'secret'}))
+        self.assertNotEqual(fingerprint, journal.get_upload_fingerprint({'s3_bucket': 'b', 'compression': 'gzip',
+                                                                         'encryption_key': 'secret'}))
+        self.assertNotIn('secret', fingerprint)
+
+    def test_recover_skips_journals_of_running_processes(self):
+        """Files of other live runs in the same temp_dir are left untouched"""
+        partial = self.touch('partial.csv')
+
+        live_journal = journal.Journal(self.dir)
+        live_journal.file_opened('s1', partial, 'partial.csv')
+
+        run_journal = journal.Journal(self.dir)
+        self.assertEqual([], journal.recover(self.dir, run_journal))
+        self.assertTrue(os.path.exists(partial))
+        self.assertEqual(2, len(glob.glob(os.path.join(self.dir, '*.jsonl'))))
+
+        live_journal.close()
+        run_journal.close()
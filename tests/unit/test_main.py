@@ -1,6 +1,11 @@
 import contextlib
+import hashlib
 import io
 import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
 from unittest.mock import patch, Mock
@@ -8,7 +13,7 @@ from unittest.mock import patch, Mock
 import pytest
 from botocore.client import BaseClient
 
-from target_s3_csv import emit_state, persist_messages
+from target_s3_csv import emit_state, get_source_ids, persist_messages, persist_sources
 
 
 class TestMain(unittest.TestCase):
@@ -30,11 +35,8 @@ class TestMain(unittest.TestCase):
             emit_state({'a': 1, 'b': 2, 'c': 'lool'})
             self.assertEqual('{"a": 1, "b": 2, "c": "lool"}\n', f.getvalue())
 
-    @patch('target_s3_csv.open')
-    @patch('target_s3_csv.csv')
     @patch('target_s3_csv.s3')
-    @patch('target_s3_csv.os')
-    def test_persist_messages(self, os, s3, csv, open):
+    def test_persist_messages(self, s3):
         messages = [
             json.dumps({"type": "SCHEMA", "stream": "my_stream",
                         "schema": {
@@ -56,7 +58,257 @@ class TestMain(unittest.TestCase):
 
         s3_client = Mock(spec_set=BaseClient)
 
-        state = persist_messages(messages, self.config, s3_client)
+        uploaded_files = []
+        s3.upload_files.side_effect = lambda files, *args, **kwargs: uploaded_files.extend(files) or files
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            state = persist_messages(messages, {**self.config, 'temp_dir': temp_dir}, s3_client)
+
+            self.assertDictEqual({"bookmarks": {"my_stream": 1}}, state)
+            s3.upload_files.assert_called_once()
+
+            self.assertEqual(1, len(uploaded_files))
+            with open(uploaded_files[0]['filename'], 'rb') as csvfile:
+                content = csvfile.read()
+
+        self.assertEqual(b'age,id,name\r\n10,1,Steve\r\n33,2,Peter\r\n25,3,Pete\r\n40,4,John\r\n', content)
+        self.assertEqual(hashlib.md5(content).hexdigest(), uploaded_files[0]['md5'])
+        self.assertEqual(len(content), uploaded_files[0]['uncompressed_length'])
+        self.assertEqual(4, uploaded_files[0]['record_count'])
+        self.assertEqual(['age', 'id', 'name'], uploaded_files[0]['columns'])
+        self.assertTrue(uploaded_files[0]['target_key'].startswith('my_stream-'))
+
+    @patch('target_s3_csv.s3')
+    def test_persist_messages_with_concurrent_runs(self, s3):
+        """Runs started in the same second write into their own local files and keep the target key"""
+        messages = [
+            json.dumps({"type": "SCHEMA", "stream": "my_stream",
+                        "schema": {"properties": {"id": {"type": "integer"}}}, "key_properties": ["id"]}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 1}}),
+        ]
+        uploaded_files = []
+        s3.upload_files.side_effect = lambda files, *args, **kwargs: uploaded_files.extend(files) or files
+
+        with tempfile.TemporaryDirectory() as temp_dir, patch('target_s3_csv.datetime') as mock_datetime:
+            mock_datetime.now.return_value.strftime.return_value = '20200131T102030'
+            for _ in range(2):
+                persist_messages(messages, {**self.config, 'temp_dir': temp_dir}, Mock())
+
+        self.assertNotEqual(uploaded_files[0]['filename'], uploaded_files[1]['filename'])
+        self.assertEqual(['my_stream-20200131T102030.csv'] * 2, [file['target_key'] for file in uploaded_files])
+
+    def persist_and_read(self, messages, config):
+        """Runs persist_messages with mocked uploads and returns the state and the content of the written files"""
+        with patch('target_s3_csv.s3') as s3, tempfile.TemporaryDirectory() as temp_dir:
+            uploaded_files = []
+            s3.upload_files.side_effect = lambda files, *args, **kwargs: uploaded_files.extend(files) or files
+
+            state = persist_messages(messages, {**self.config, 'temp_dir': temp_dir, **config}, Mock())
+
+            contents = {}
+            for file in uploaded_files:
+                with open(file['filename'], 'rb') as csvfile:
+                    contents[file['target_key']] = csvfile.read()
+
+        return state, contents
+
+    def test_persist_messages_with_csv_dialect(self):
+        messages = [
+            json.dumps({"type": "SCHEMA", "stream": "my_stream",
+                        "schema": {
+                            "properties": {
+                                "id": {"type": "integer"},
+                                "name": {"type": ["string", "null"]},
+                                "active": {"type": ["boolean", "null"]},
+                            },
+                        },
+                        "key_properties": ["id"]}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 1, "name": "a,b", "active": True}}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 2, "name": None, "active": False}}),
+        ]
+
+        _, contents = self.persist_and_read(messages, {'csv_dialect': 'redshift', 'naming_convention': 'out.csv'})
+
+        self.assertEqual({'out.csv': b'active,id,name\ntrue,1,"a,b"\nfalse,2,\\N\n'}, contents)
+
+        messages[1] = json.dumps({"type": "RECORD", "stream": "my_stream",
+                                  "record": {"id": 1, "name": 'a "b"', "active": True}})
+        _, contents = self.persist_and_read(messages, {'csv_dialect': 'redshift', 'escapechar': '\\',
+                                                       'naming_convention': 'out.csv'})
+
+        self.assertEqual({'out.csv': b'active,id,name\ntrue,1,"a \\"b\\""\nfalse,2,\\N\n'}, contents)
+
+    def test_persist_messages_with_deduplication(self):
+        messages = [
+            json.dumps({"type": "SCHEMA", "stream": "my_stream",
+                        "schema": {"properties": {"id": {"type": "integer"}, "name": {"type": "string"}}},
+                        "key_properties": ["id"]}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 1, "name": "a"}}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 2, "name": "b"}}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 1, "name": "c"}}),
+        ]
+
+        _, contents = self.persist_and_read(messages, {'deduplicate_records': True, 'naming_convention': 'out.csv'})
+
+        self.assertEqual({'out.csv': b'id,name\r\n2,b\r\n1,c\r\n'}, contents)
+
+    def test_persist_messages_with_projection_and_filter(self):
+        """Unselected columns and filtered records are dropped before validation"""
+        messages = [
+            json.dumps({"type": "SCHEMA", "stream": "my_stream",
+                        "schema": {"properties": {"id": {"type": "integer"}, "name": {"type": "string"},
+                                                  "payload": {"type": "integer"}}},
+                        "key_properties": ["id"]}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 1, "name": "a", "payload": 1}}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 2, "name": "b", "payload": "x"}}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 3, "name": "c", "payload": 3}}),
+        ]
+
+        _, contents = self.persist_and_read(messages, {'select_columns': {'my_stream': ['id', 'name']},
+                                                       'record_filters': {'my_stream': 'id >= 2'},
+                                                       'naming_convention': 'out.csv'})
+
+        self.assertEqual({'out.csv': b'id,name\r\n2,b\r\n3,c\r\n'}, contents)
+
+    def test_persist_messages_with_fractional_number_filters(self):
+        """Numbers of parsed records are Decimals, fractional literals of filters have to match them"""
+        messages = [
+            json.dumps({"type": "SCHEMA", "stream": "my_stream",
+                        "schema": {"properties": {"id": {"type": "integer"}, "amount": {"type": "number"}}},
+                        "key_properties": ["id"]}),
+            '{"type": "RECORD", "stream": "my_stream", "record": {"id": 1, "amount": 0.1}}',
+            '{"type": "RECORD", "stream": "my_stream", "record": {"id": 2, "amount": 0.2}}',
+            '{"type": "RECORD", "stream": "my_stream", "record": {"id": 3, "amount": 0.3}}',
+        ]
+
+        for expression, expected in (('amount == 0.1', b'amount,id\r\n0.1,1\r\n'),
+                                     ('amount in (0.2, 0.3)', b'amount,id\r\n0.2,2\r\n0.3,3\r\n'),
+                                     ('amount in [0.1] or amount > 0.25', b'amount,id\r\n0.1,1\r\n0.3,3\r\n')):
+            _, contents = self.persist_and_read(messages, {'record_filters': {'my_stream': expression},
+                                                           'naming_convention': 'out.csv'})
+            self.assertEqual({'out.csv': expected}, contents, expression)
+
+    def test_persist_messages_sorts_coerced_numbers_numerically(self):
+        """Numbers coerced into fixed point strings are still sorted as numbers"""
+        messages = [
+            json.dumps({"type": "SCHEMA", "stream": "my_stream",
+                        "schema": {"properties": {"id": {"type": "integer"}, "amount": {"type": "number"}}},
+                        "key_properties": ["id"]}),
+        ] + [
+            '{"type": "RECORD", "stream": "my_stream", "record": {"id": %d, "amount": %s}}' % (i, amount)
+            for i, amount in enumerate(('9.5', '10.25', '100', '2'))
+        ]
+
+        _, contents = self.persist_and_read(messages, {'coerce_types': True,
+                                                       'sort_columns': {'my_stream': ['amount']},
+                                                       'naming_convention': 'out.csv'})
+
+        self.assertEqual({'out.csv': b'amount,id\r\n2,3\r\n9.5,0\r\n10.25,1\r\n100,2\r\n'}, contents)
+
+    def test_persist_messages_rejects_projection_without_keys(self):
+        """Deduplication and sorting fail loudly if their columns are not selected"""
+        messages = [
+            json.dumps({"type": "SCHEMA", "stream": "my_stream",
+                        "schema": {"properties": {"id": {"type": "integer"}, "name": {"type": "string"}}},
+                        "key_properties": ["id"]}),
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": 1, "name": "a"}}),
+        ]
+
+        for config in ({'deduplicate_records': True}, {'sort_records': True}, {'sort_columns': {'my_stream': ['id']}}):
+            with self.assertRaisesRegex(Exception, 'Columns id of stream my_stream'):
+                self.persist_and_read(messages, {'select_columns': {'my_stream': ['name']}, **config})
+
+    @patch('target_s3_csv.flush.metrics.log')
+    def test_persist_messages_with_flush_policy(self, log):
+        """Files reaching the target size are uploaded during the run and numbered"""
+        messages = [
+            json.dumps({"type": "SCHEMA", "stream": "my_stream",
+                        "schema": {"properties": {"id": {"type": "integer"}, "text": {"type": "string"}}},
+                        "key_properties": ["id"]}),
+        ] + [
+            json.dumps({"type": "RECORD", "stream": "my_stream", "record": {"id": i, "text": 'x' * 10000}})
+            for i in range(3)
+        ]
+
+        _, contents = self.persist_and_read(messages, {'flush_streams': {'my_stream': {'target_file_size_mb': 0.015}},
+                                                       'naming_convention': 'out.csv'})
+
+        self.assertEqual(['out.csv', 'out-1.csv'], list(contents))
+        self.assertEqual([b'id,text', b'0,' + b'x' * 10000, b'1,' + b'x' * 10000, b''],
+                         contents['out.csv'].split(b'\r\n'))
+        self.assertEqual([b'id,text', b'2,' + b'x' * 10000, b''], contents['out-1.csv'].split(b'\r\n'))
+        self.assertEqual(['size', 'end'], [call[0][1].tags['reason'] for call in log.call_args_list])
+
+    @patch('target_s3_csv.s3')
+    def test_persist_messages_without_records_skips_s3(self, s3):
+        messages = [
+            json.dumps({"type": "SCHEMA", "stream": "my_stream",
+                        "schema": {"properties": {"id": {"type": "integer"}}},
+                        "key_properties": ["id"]}),
+            json.dumps({"type": "STATE", "value": {"bookmarks": {"my_stream": 1}}}),
+        ]
+        s3_client = Mock()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            state = persist_messages(messages, {**self.config, 'temp_dir': temp_dir}, s3_client)
 
         self.assertDictEqual({"bookmarks": {"my_stream": 1}}, state)
-        s3.upload_files.assert_called_once()
+        s3.upload_files.assert_not_called()
+        self.assertEqual([], s3_client.method_calls)
+
+    def test_import_does_not_load_heavy_modules(self):
+        """Guards the startup time: boto3, botocore and inflection are loaded only when they are used"""
+        code = (
+            "import sys\n"
+            "import target_s3_csv\n"
+            "loaded = [m for m in ('boto3.session', 'botocore.client', 's3transfer') if m in sys.modules]\n"
+            "for m in ('boto3', 'botocore', 'botocore.exceptions', 'inflection'):\n"
+            "    if m in sys.modules and type(sys.modules[m]).__name__ != '_LazyModule':\n"
+            "        loaded.append(m)\n"
+            "print(','.join(loaded))\n"
+        )
+        repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=repo_dir)
+
+        self.assertEqual('', result.stdout.strip())
+
+    @patch('target_s3_csv.s3')
+    def test_persist_sources(self, s3):
+        """Fan-in mode keeps the files and the state of every source separate"""
+        uploaded_keys = []
+        s3.upload_files.side_effect = \
+            lambda files, *args, **kwargs: uploaded_keys.extend(f['target_key'] for f in files) or files
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            inputs = []
+            for name, bookmark in (('tap_a', 1), ('tap_b', 2)):
+                path = os.path.join(temp_dir, name)
+                with open(path, 'w') as input_file:
+                    input_file.write(json.dumps({"type": "SCHEMA", "stream": "users",
+                                                 "schema": {"properties": {"id": {"type": "integer"}}},
+                                                 "key_properties": ["id"]}) + '\n')
+                    input_file.write(json.dumps({"type": "RECORD", "stream": "users", "record": {"id": 1}}) + '\n')
+                    input_file.write(json.dumps({"type": "STATE", "value": {"bookmark": bookmark}}) + '\n')
+                inputs.append(path)
+
+            f = io.StringIO()
+            with contextlib.redirect_stdout(f):
+                # Inputs are in temp_dir too, they must not collide with the temp directories of the sources
+                failed = persist_sources(inputs + [os.path.join(temp_dir, 'missing')],
+                                         {**self.config, 'temp_dir': temp_dir},
+                                         Mock())
+
+        self.assertEqual(1, failed)
+        self.assertEqual([{'source': inputs[0], 'value': {'bookmark': 1}},
+                          {'source': inputs[1], 'value': {'bookmark': 2}}],
+                         sorted((json.loads(line) for line in f.getvalue().splitlines()),
+                                key=lambda state: state['source']))
+        self.assertEqual(2, len(set(uploaded_keys)))
+        self.assertEqual(['users-tap_a-', 'users-tap_b-'], sorted(key[:12] for key in uploaded_keys))
+
+    def test_get_source_ids(self):
+        """Inputs with the same file name get suffixes that don't collide with the names of other inputs"""
+        self.assertEqual(['x', 'x-2', 'x-3'], get_source_ids(['/a/x', '/b/x-2', '/c/x']))
+        self.assertEqual(['x', 'x-1', 'x-2', 'x-2-3', 'input'], get_source_ids(['/a/x', '/b/x', '/c/x', '/d/x-2', '/']))
+        self.assertEqual(['tap_a', 'tap_a-1', 'tap_a-2', 'my_pipe'],
+                         get_source_ids(['/a/tap_a', '/b/tap_a/', '/c/tap_a', '/d/my pipe']))
@@ -0,0 +1,91 @@
+import os
+import pstats
+import tempfile
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from target_s3_csv import profiling
+from target_s3_csv import utils
+
+
+def busy_loop(seconds):
+    until = time.perf_counter() + seconds
+    while time.perf_counter() < until:
+        pass
+
+
+class TestProfiling(unittest.TestCase):
+    """
+    Unit Tests for profiling module
+    """
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_cprofile(self):
+        """cProfile mode writes a pstats file when the run is finished"""
+        with profiling.Profile('cprofile', self.temp_dir.name) as profile:
+            busy_loop(0.01)
+
+        self.assertTrue(profile.path.endswith('.pstats'))
+        functions = [func for _, _, func in pstats.Stats(profile.path).stats]
+        self.assertIn('busy_loop', functions)
+
+    def test_cprofile_record_sampling(self):
+        """Only every Nth message is profiled"""
+        processed = []
+        with profiling.Profile('cprofile', self.temp_dir.name, record_sample_rate=3) as profile:
+            for message in profile.wrap_messages(range(7)):
+                processed.append(message)
+                busy_loop(0.001)
+
+        self.assertEqual(list(range(7)), processed)
+        stats = pstats.Stats(profile.path).stats
+        busy_loop_calls = [stat[1] for (_, _, func), stat in stats.items() if func == 'busy_loop']
+        # messages 0, 3 and 6
+        self.assertEqual([3], busy_loop_calls)
+
+    def test_cprofile_worker_threads(self):
+        """Work of fan-in worker threads is profiled and merged into the same file, with or without sampling"""
+        def worker(profile, seconds):
+            with profile.profile_thread():
+                for _ in profile.wrap_messages(range(4)):
+                    busy_loop(seconds)
+
+        for record_sample_rate, expected_calls in ((None, 8), (2, 4)):
+            with profiling.Profile('cprofile', self.temp_dir.name, record_sample_rate=record_sample_rate) as profile:
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    for future in [executor.submit(worker, profile, 0.001) for _ in range(2)]:
+                        future.result()
+
+            stats = pstats.Stats(profile.path).stats
+            self.assertEqual([expected_calls], [stat[1] for (_, _, func), stat in stats.items() if func == 'busy_loop'])
+            os.remove(profile.path)
+
+    def test_sampling_profiler(self):
+        """Sampling mode writes collapsed stacks"""
+        with profiling.Profile('sampling', self.temp_dir.name) as profile:
+            busy_loop(0.1)
+
+        self.assertTrue(profile.path.endswith('.collapsed'))
+        with open(profile.path) as collapsed:
+            lines = collapsed.read().splitlines()
+        self.assertTrue(any('test_profiling.py:busy_loop' in line for line in lines))
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(NotImplementedError):
+            profiling.Profile('perf', self.temp_dir.name)
+
+        self.assertGreater(len(utils.validate_config({'s3_bucket': 'b', 'profile': 'perf'})), 0)
+        self.assertEqual(0, len(utils.validate_config({'s3_bucket': 'b', 'profile': True})))
+        for sample_rate in ('10', 0, 1.5, True):
+            self.assertEqual(1, len(utils.validate_config({'s3_bucket': 'b', 'profile_record_sample_rate': sample_rate})))
+        self.assertEqual(0, len(utils.validate_config({'s3_bucket': 'b', 'profile_record_sample_rate': 10})))
+        self.assertEqual([], os.listdir(self.temp_dir.name))
@@ -0,0 +1,61 @@
+import unittest
+
+from decimal import Decimal
+
+from target_s3_csv import projection
+
+
+class TestProjection(unittest.TestCase):
+    """
+    Unit Tests for projection module
+    """
+
+    def test_project_schema(self):
+        """Unselected properties are removed, metadata columns are kept"""
+        schema = {
+            'type': 'object',
+            'properties': {'id': {'type': 'integer'}, 'name': {'type': 'string'}, 'blob': {'type': 'string'},
+                           '_sdc_deleted_at': {'type': ['null', 'string']}},
+            'required': ['id', 'blob'],
+        }
+
+        projected = projection.project_schema(schema, ['id', 'name'])
+
+        self.assertEqual(['id', 'name', '_sdc_deleted_at'], list(projected['properties']))
+        self.assertEqual(['id'], projected['required'])
+        self.assertEqual('object', projected['type'])
+        self.assertIn('blob', schema['properties'])
+
+    def test_make_projector(self):
+        project = projection.make_projector(['id', 'missing'])
+
+        self.assertEqual({'id': 1, '_sdc_deleted_at': None},
+                         project({'id': 1, 'blob': 'x' * 100, '_sdc_deleted_at': None}))
+
+    def test_get_missing_columns(self):
+        self.assertEqual(['name'], projection.get_missing_columns(['id', 'name', 'address__city', '_sdc_sequence'],
+                                                                  ['id', 'address']))
+
+    def test_compile_filter(self):
+        record_filter = projection.compile_filter(
+            "status in ('active', 'pending') and amount >= 10 and not address.city == 'Paris'")
+
+        self.assertTrue(record_filter({'status': 'active', 'amount': 10, 'address': {'city': 'London'}}))
+        self.assertFalse(record_filter({'status': 'closed', 'amount': 10, 'address': {'city': 'London'}}))
+        self.assertFalse(record_filter({'status': 'active', 'amount': 10, 'address': {'city': 'Paris'}}))
+        # Missing and null values compare like null, never failing
+        self.assertFalse(record_filter({'status': 'active'}))
+        self.assertTrue(projection.compile_filter('deleted_at is None')({'id': 1}))
+        self.assertTrue(projection.compile_filter('0 < amount < 5 or id == 7')({'id': 7}))
+
+    def test_compile_filter_with_fractional_numbers(self):
+        """Float literals match the Decimal numbers of records parsed by singer"""
+        self.assertTrue(projection.compile_filter('amount == 0.1')({'amount': Decimal('0.1')}))
+        self.assertTrue(projection.compile_filter('amount in (0.1, 0.2)')({'amount': Decimal('0.2')}))
+        self.assertTrue(projection.compile_filter('amount in {1.5}')({'amount': Decimal('1.5')}))
+        self.assertFalse(projection.compile_filter('amount in [0.1]')({'amount': Decimal('0.3')}))
+
+    def test_compile_filter_rejects_code(self):
+        for expression in ("__import__('os').system('ls')", 'amount +', 'amount * 2 > 1', 'record[0] == 1'):
+            with self.assertRaises(ValueError):
+                projection.compile_filter(expression)
@@ -1,9 +1,14 @@
+import base64
+import gzip
+import hashlib
+import json
 import os
 import tempfile
 import unittest
 from unittest.mock import patch, Mock, call
 
 from botocore.client import BaseClient
+from botocore.exceptions import ClientError
 
 from target_s3_csv import s3
 
@@ -21,6 +26,25 @@ class TestS3(unittest.TestCase):
         s3.create_client(config)
         mock_client.assert_called_with('s3', endpoint_url='other_url')
 
+    @patch("target_s3_csv.s3.boto3.session.Session.client")
+    def test_create_client_with_max_pool_connections(self, mock_client):
+        """Test that the connection pool of the client is sized as requested"""
+        s3.create_client({'aws_access_key_id': 'foo', 'aws_secret_access_key': 'bar'}, max_pool_connections=32)
+
+        self.assertEqual(32, mock_client.call_args[1]['config'].max_pool_connections)
+
+    @patch("target_s3_csv.s3.create_client")
+    def test_lazy_client(self, mock_create_client):
+        """Test that the client is created only when it's used first"""
+        s3_client = s3.LazyClient({'s3_bucket': 'my_bucket'})
+        mock_create_client.assert_not_called()
+
+        s3_client.upload_file('file.csv', 'my_bucket', 'file.csv')
+        s3_client.upload_file('file.csv', 'my_bucket', 'file.csv')
+
+        mock_create_client.assert_called_once_with({'s3_bucket': 'my_bucket'}, None)
+        self.assertEqual(2, mock_create_client.return_value.upload_file.call_count)
+
     def test_upload_files_with_no_compression_nor_encryption(self):
         file1 = tempfile.NamedTemporaryFile(suffix='.csv')
         file2 = tempfile.NamedTemporaryFile(suffix='.csv')
@@ -134,3 +158,132 @@ class TestS3(unittest.TestCase):
         self.assertFalse(os.path.exists(file1.name))
         self.assertFalse(os.path.exists(file2.name))
         self.assertFalse(os.path.exists(file3.name))
+
+    def test_upload_files_with_checksum(self):
+        file1 = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        file1.write(b'id\r\n1\r\n')
+        file1.close()
+        md5 = hashlib.md5(b'id\r\n1\r\n').hexdigest()
+
+        s3_client = Mock(**{
+            'put_object.return_value': None
+        })
+
+        uploaded_files = s3.upload_files(
+            [{'filename': file1.name, 'target_key': 'folder1/file.csv', 'md5': md5}],
+            s3_client,
+            'my_bucket',
+            None,
+            None,
+            None
+        )
+
+        # small files are sent in a single request with a Content-MD5 header
+        s3_client.upload_file.assert_not_called()
+        s3_client.put_object.assert_called_once()
+        kwargs = s3_client.put_object.call_args[1]
+        self.assertEqual('folder1/file.csv', kwargs['Key'])
+        self.assertEqual(base64.b64encode(bytes.fromhex(md5)).decode(), kwargs['ContentMD5'])
+        self.assertEqual({'md5': md5}, kwargs['Metadata'])
+
+        self.assertEqual([{'filename': file1.name, 'target_key': 'folder1/file.csv', 'md5': md5, 'size': 7}],
+                         uploaded_files)
+        self.assertFalse(os.path.exists(file1.name))
+
+    def test_upload_files_with_compression_checksums_compressed_file(self):
+        file1 = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        file1.write(b'id\r\n1\r\n')
+        file1.close()
+
+        s3_client = Mock()
+        uploaded_bodies = []
+        s3_client.put_object.side_effect = lambda **kwargs: uploaded_bodies.append(kwargs['Body'].read())
+
+        uploaded_files = s3.upload_files(
+            [{'filename': file1.name, 'target_key': 'folder1/file.csv', 'md5': 'not-the-compressed-md5'}],
+            s3_client,
+            'my_bucket',
+            'gzip',
+            None,
+            None
+        )
+
+        self.assertEqual(b'id\r\n1\r\n', gzip.decompress(uploaded_bodies[0]))
+        self.assertEqual(hashlib.md5(uploaded_bodies[0]).hexdigest(), uploaded_files[0]['md5'])
+        self.assertEqual('folder1/file.csv.gz', uploaded_files[0]['target_key'])
+
+    def test_upload_files_skips_unchanged_objects(self):
+        file1 = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        file2 = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        file3 = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        file1.close()
+        file2.close()
+        file3.close()
+
+        md5_1, md5_2 = hashlib.md5(b'1').hexdigest(), hashlib.md5(b'2').hexdigest()
+
+        def head_object(Bucket, Key):
+            if Key == 'folder1/file.csv':
+                return {'Metadata': {'md5': md5_1}}
+            if Key == 'folder2/file.csv':
+                raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            # Missing objects are forbidden without s3:ListBucket permission
+            raise ClientError({'Error': {'Code': '403'}}, 'HeadObject')
+
+        s3_client = Mock()
+        s3_client.head_object.side_effect = head_object
+
+        s3.upload_files(
+            [
+                {'filename': file1.name, 'target_key': 'folder1/file.csv', 'md5': md5_1},
+                {'filename': file2.name, 'target_key': 'folder2/file.csv', 'md5': md5_2},
+                {'filename': file3.name, 'target_key': 'folder3/file.csv', 'md5': md5_2},
+            ],
+            s3_client,
+            'my_bucket',
+            None,
+            None,
+            None,
+            skip_unchanged=True
+        )
+
+        # only the missing objects are uploaded
+        self.assertEqual(['folder2/file.csv', 'folder3/file.csv'],
+                         [call[1]['Key'] for call in s3_client.put_object.call_args_list])
+        self.assertFalse(os.path.exists(file1.name))
+        self.assertFalse(os.path.exists(file2.name))
+        self.assertFalse(os.path.exists(file3.name))
+
+    def test_upload_files_with_manifest(self):
+        file1 = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        file1.write(b'id,name\r\n1,a\r\n2,b\r\n')
+        file1.close()
+
+        s3_client = Mock()
+        uploaded_bodies = {}
+
+        def put_object(Body, Key, **kwargs):
+            uploaded_bodies[Key] = Body if isinstance(Body, bytes) else Body.read()
+        s3_client.put_object.side_effect = put_object
+
+        s3.upload_files(
+            [{'filename': file1.name, 'target_key': 'folder1/file.csv', 'md5': hashlib.md5(b'x').hexdigest(),
+              'record_count': 2, 'uncompressed_length': 20, 'columns': ['id', 'name']}],
+            s3_client,
+            'my_bucket',
+            'gzip',
+            None,
+            None,
+            manifest_key='manifest.json'
+        )
+
+        manifest = json.loads(uploaded_bodies['manifest.json'])
+        self.assertEqual(1, len(manifest['entries']))
+        entry = manifest['entries'][0]
+        self.assertEqual('s3://my_bucket/folder1/file.csv.gz', entry['url'])
+        self.assertTrue(entry['mandatory'])
+        self.assertEqual(2, entry['meta']['record_count'])
+        self.assertEqual(20, entry['meta']['uncompressed_length'])
+        self.assertEqual(['id', 'name'], entry['meta']['columns'])
+        self.assertEqual(hashlib.md5(uploaded_bodies['folder1/file.csv.gz']).hexdigest(), entry['meta']['md5'])
+        self.assertEqual(len(uploaded_bodies['folder1/file.csv.gz']), entry['meta']['content_length'])
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+from decimal import Decimal
+
+from target_s3_csv import sort
+from target_s3_csv.writer import StreamWriter
+
+
+class TestSort(unittest.TestCase):
+    """
+    Unit Tests for sort module
+    """
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def test_sort_key(self):
+        """Numbers are sorted numerically, mixed types don't fail and nulls come last"""
+        sort_key = sort.make_sort_key(['a'])
+        values = [None, 'b', 10, Decimal('2.5'), 'a', 1]
+
+        self.assertEqual([1, Decimal('2.5'), 10, 'a', 'b', None],
+                         sorted(values, key=lambda value: sort_key({'a': value})))
+
+    def test_sort_key_of_numeric_columns(self):
+        """Numeric strings of numeric columns are sorted numerically, other strings by their text"""
+        schema = {'properties': {'a': {'type': ['null', 'number']}, 'b': {'type': 'string'}}}
+        sort_key = sort.make_sort_key(['a', 'b'], schema)
+        records = [{'a': '9.5', 'b': '9'}, {'a': '10.25', 'b': '10'}, {'a': None, 'b': '2'},
+                   {'a': 'NaN', 'b': '1'}, {'a': '2', 'b': '100'}, {'a': 100, 'b': '5'}]
+
+        self.assertEqual(['100', '9', '10', '5', '1', '2'],
+                         [record['b'] for record in sorted(records, key=sort_key)])
+
+    def test_external_sorter_in_memory(self):
+        sorter = sort.ExternalSorter(os.path.join(self.temp_dir.name, 'stream.csv'))
+        for key, row in ((2, b'b'), (1, b'a'), (2, b'c')):
+            sorter.add((key,), row)
+
+        self.assertEqual([b'a', b'b', b'c'], list(sorter.rows()))
+        self.assertEqual([], sorter.runs)
+        sorter.close()
+
+    def test_external_sorter_merges_runs_on_disk(self):
+        """Rows are spilled into sorted runs and merged, equal keys keep their arrival order"""
+        sorter = sort.ExternalSorter(os.path.join(self.temp_dir.name, 'stream.csv'),
+                                     max_bytes_in_memory=3 * sort.ROW_OVERHEAD_BYTES)
+        rows = [(5, b'5a'), (3, b'3a'), (9, b'9a'), (1, b'1a'), (3, b'3b'), (5, b'5b'), (0, b'0a')]
+        for key, row in rows:
+            sorter.add((key,), row)
+
+        self.assertEqual([b'0a', b'1a', b'3a', b'3b', b'5a', b'5b', b'9a'], list(sorter.rows()))
+        self.assertEqual(3, len(sorter.runs))
+
+        sorter.close()
+        self.assertEqual([], os.listdir(self.temp_dir.name))
+
+    def test_stream_writer_sorts_deduplicated_rows(self):
+        filename = os.path.join(self.temp_dir.name, 'stream.csv')
+        writer = StreamWriter(filename, 'stream.csv', key_properties=['id'], sort_columns=['name'],
+                              sort_max_bytes_in_memory=2 * sort.ROW_OVERHEAD_BYTES)
+        for record in ({'id': 1, 'name': 'z'}, {'id': 2, 'name': 'b'}, {'id': 3, 'name': 'c'},
+                       {'id': 1, 'name': 'a'}, {'id': 4, 'name': None}):
+            writer.write(record)
+        file = writer.close()
+
+        with open(filename, 'rb') as csvfile:
+            self.assertEqual(b'id,name\r\n1,a\r\n2,b\r\n3,c\r\n4,\r\n', csvfile.read())
+        self.assertEqual(4, file['record_count'])
+        self.assertEqual(['stream.csv'], os.listdir(self.temp_dir.name))
@@ -27,6 +27,9 @@ class TestUtils(unittest.TestCase):
         # Minimal configuration should pass - (nr_of_errors == 0)
         self.assertEqual(len(utils.validate_config(minimal_config)), 0)
 
+        # Invalid record filters should fail
+        self.assertEqual(len(utils.validate_config({**minimal_config, 'record_filters': {'s': 'id +'}})), 1)
+
     def test_naming_convention_replaces_tokens(self):
         """Test that the naming_convention tokens are replaced"""
         message = {
@@ -39,6 +42,20 @@ class TestUtils(unittest.TestCase):
 
         self.assertEqual('test_the_stream_fake_timestamp_test.csv', s3_key)
 
+    def test_naming_convention_numbers_parts(self):
+        """Test that files flushed during the run get unique keys"""
+        message = {
+            'stream': 'the_stream'
+        }
+
+        self.assertEqual('folder/the.stream.csv', utils.get_target_key({'stream': 'the.stream'},
+                                                                      naming_convention='folder/{stream}.csv'))
+        self.assertEqual('folder/the.stream-2.csv', utils.get_target_key({'stream': 'the.stream'}, part=2,
+                                                                        naming_convention='folder/{stream}.csv'))
+        self.assertEqual('the_stream/0/1.csv', utils.get_target_key(message, naming_convention='{stream}/{part}/1.csv'))
+        self.assertEqual('the_stream/3/1.csv', utils.get_target_key(message, part=3,
+                                                                    naming_convention='{stream}/{part}/1.csv'))
+
     def test_naming_convention_has_reasonable_default(self):
         """Test the default value of the naming convention"""
         message = {
@@ -59,3 +76,12 @@ class TestUtils(unittest.TestCase):
                                       naming_convention='folder1/test_{stream}_test.csv')
 
         self.assertEqual('folder1/the_prefix__test_the_stream_test.csv', s3_key)
+
+    def test_get_sort_columns(self):
+        """Test that configured sort columns take precedence over the key properties"""
+        config = {'sort_records': True, 'sort_columns': {'stream_a': ['updated_at', 'id']}}
+
+        self.assertEqual(['updated_at', 'id'], utils.get_sort_columns(config, 'stream_a', ['id']))
+        self.assertEqual(['id'], utils.get_sort_columns(config, 'stream_b', ['id']))
+        self.assertIsNone(utils.get_sort_columns(config, 'stream_c', []))
+        self.assertIsNone(utils.get_sort_columns({}, 'stream_a', ['id']))